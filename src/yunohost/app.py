@@ -25,6 +25,7 @@
 """
 import os
 import sys
+import copy
 import json
 import shutil
 import stat
@@ -34,22 +35,83 @@ import re
 import socket
 import urlparse
 import errno
+import pipes
 import subprocess
+import fcntl
+import glob
+import hashlib
+import tarfile
+import tempfile
+import zipfile
+import threading
+import requests
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager, closing
 
 from moulinette.core import MoulinetteError
 from moulinette.utils.log import getActionLogger
 
 from yunohost.service import service_log
 from yunohost.utils import packages
+from yunohost.utils.filesystem import set_permissions
 
 logger = getActionLogger('yunohost.app')
 
 repo_path        = '/var/cache/yunohost/repo'
+appslist_index   = '/var/cache/yunohost/appslist.index'
+upgrades_index   = '/var/cache/yunohost/upgrades.index'
+locations_index  = '/var/cache/yunohost/locations.index'
 apps_path        = '/usr/share/yunohost/apps'
 apps_setting_path= '/etc/yunohost/apps/'
+instances_registry = '/etc/yunohost/apps_instances.json'
 install_tmp      = '/var/cache/yunohost'
 app_tmp_folder   = install_tmp + '/from_file'
+app_upgrade_tmp  = install_tmp + '/upgrade'
+git_cache_path   = install_tmp + '/git'
+archive_store_path = install_tmp + '/archives'
+ssowat_conf_path = '/etc/ssowat/conf.json'
+ssowat_regen_queue = install_tmp + '/ssowat_regen.queue'
+
+# Loaded apps list index header
+_appslist_index_cache = {}
+
+# Serialize updates of the upgrade candidates index between threads
+_upgrades_index_lock = threading.Lock()
+
+# Archives of the store in use by threads of this process - which are not
+# pruned - with their number of users, and the lock protecting them
+_archive_store_pins = {}
+_archive_store_lock = threading.Lock()
+
+# Loaded apps locations index and the key of the file it was loaded from,
+# and the locks which serialize its updates between threads and processes
+_locations_index_cache = {}
+_locations_index_lock = threading.RLock()
+_locations_index_flock = {'depth': 0, 'file': None}
+
+# Parsed apps settings by app id, with the (inode, mtime, size) of their file
+_app_settings_cache = {}
+_app_settings_cache_stats = {'hits': 0, 'misses': 0}
+
+# Use the LibYAML based loader if available
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# ioctl request to clone a file on copy-on-write filesystems
+FICLONE = 0x40049409
+
+# Maximum size of the apps git cache in bytes
+git_cache_max_size = 1024 * 1024 * 1024
+
+# Maximum size of the apps sources archive store in bytes
+archive_store_max_size = 512 * 1024 * 1024
+
+# Maximum number of apps sources to fetch at the same time
+app_fetch_workers = 4
+
+# SSOwat configuration changes deferred by the current batch, and whether
+# a full regeneration has been requested within it
+_ssowatconf_batch_state = {'depth': 0, 'changes': [], 'full': False}
 
 re_github_repo = re.compile(
     r'^(http[s]?://|git@)github.com[/:]'
@@ -57,6 +119,12 @@ re_github_repo = re.compile(
     '(/tree/(?P<tree>.+))?'
 )
 
+re_git_commit = re.compile(r'^[0-9a-f]{40}$')
+
+re_appslist_cron = re.compile(
+    r'fetchlist -u (?P<url>\S+) -n (?P<name>\S+)'
+)
+
 re_app_instance_name = re.compile(
     r'^(?P<appid>[\w]+?)(__(?P<appinstancenb>[1-9][0-9]*))?$'
 )
@@ -84,8 +152,8 @@ def app_fetchlist(url=None, name=None):
     Fetch application list from app server
 
     Keyword argument:
-        name -- Name of the list (default yunohost)
-        url -- URL of remote JSON list (default https://app.yunohost.org/official.json)
+        name -- Name of the list, required with url
+        url -- URL of remote JSON list (default all registered lists)
 
     """
     # Create app path if not exists
@@ -93,23 +161,43 @@ def app_fetchlist(url=None, name=None):
     except OSError: os.makedirs(repo_path)
 
     if url is None:
-        url = 'https://app.yunohost.org/official.json'
-        name = 'yunohost'
+        appslists = _get_registered_appslists()
     else:
         if name is None:
             raise MoulinetteError(errno.EINVAL,
                                   m18n.n('custom_appslist_name_required'))
+        appslists = OrderedDict([(name, url)])
 
-    list_file = '%s/%s.json' % (repo_path, name)
-    if os.system('wget "%s" -O "%s.tmp"' % (url, list_file)) != 0:
-        os.remove('%s.tmp' % list_file)
-        raise MoulinetteError(errno.EBADR, m18n.n('appslist_retrieve_error'))
+    def _fetch(appslist):
+        try:
+            return _fetch_appslist(*appslist)
+        except MoulinetteError as e:
+            return e
+
+    # Fetch lists concurrently
+    pool = ThreadPool(min(len(appslists), app_fetch_workers))
+    try:
+        results = pool.map(_fetch, appslists.items())
+    finally:
+        pool.close()
+        pool.join()
 
-    # Rename fetched temp list
-    os.rename('%s.tmp' % list_file, list_file)
+    errors = []
+    for (name, url), result in zip(appslists.items(), results):
+        if isinstance(result, MoulinetteError):
+            errors.append(result)
+            continue
+        os.system("touch /etc/cron.d/yunohost-applist-%s" % name)
+        os.system("echo '00 00 * * * root yunohost app fetchlist -u %s -n %s > /dev/null 2>&1' >/etc/cron.d/yunohost-applist-%s" % (url, name, name))
+
+    # Merge modified lists into the apps list index and compare them with
+    # installed apps
+    if any(result is True for result in results):
+        _build_appslist_index()
+        _build_upgrades_index()
 
-    os.system("touch /etc/cron.d/yunohost-applist-%s" % name)
-    os.system("echo '00 00 * * * root yunohost app fetchlist -u %s -n %s > /dev/null 2>&1' >/etc/cron.d/yunohost-applist-%s" % (url, name, name))
+    if errors:
+        raise errors[0]
 
     logger.success(m18n.n('appslist_fetched'))
 
@@ -127,6 +215,10 @@ def app_removelist(name):
         os.remove("/etc/cron.d/yunohost-applist-%s" % name)
     except OSError:
         raise MoulinetteError(errno.ENOENT, m18n.n('appslist_unknown'))
+    try:
+        os.remove('%s/%s.validators' % (repo_path, name))
+    except OSError:
+        pass
 
     logger.success(m18n.n('appslist_removed'))
 
@@ -150,7 +242,6 @@ def app_list(offset=None, limit=None, filter=None, raw=False, installed=False, w
     else: limit = 1000
     installed = with_backup or installed
 
-    app_dict = {}
     if raw:
         list_dict = {}
     else:
@@ -161,73 +252,91 @@ def app_list(offset=None, limit=None, filter=None, raw=False, installed=False, w
         applists[0]
     except (IOError, IndexError):
         app_fetchlist()
-        applists = app_listlists()['lists']
 
-    for applist in applists:
-        with open(os.path.join(repo_path, applist + '.json')) as json_list:
-            for app, info in json.loads(str(json_list.read())).items():
-                if app not in app_dict:
-                    info['repository'] = applist
-                    app_dict[app] = info
+    index = _get_appslist_index()
 
+    # Retrieve the name and the index entry - or the info for custom
+    # apps - of each app, without loading their info from the catalog
+    app_entries = dict(index['apps'])
+    custom_apps = {}
     for app in os.listdir(apps_setting_path):
-        if app not in app_dict:
+        if app not in app_entries:
             # Look for forks
             if '__' in app:
                 original_app = app[:app.index('__')]
-                if original_app in app_dict:
-                    app_dict[app] = app_dict[original_app]
+                if original_app in app_entries:
+                    app_entries[app] = app_entries[original_app]
                     continue
             with open( apps_setting_path + app +'/manifest.json') as json_manifest:
-                app_dict[app] = {"manifest":json.loads(str(json_manifest.read()))}
-            app_dict[app]['repository'] = None
-
-    if len(app_dict) > (0 + offset) and limit > 0:
-        sorted_app_dict = {}
-        for sorted_keys in sorted(app_dict.keys())[offset:]:
-            sorted_app_dict[sorted_keys] = app_dict[sorted_keys]
-
-        i = 0
-        for app_id, app_info_dict in sorted_app_dict.items():
-            if i < limit:
-                if (filter and ((filter in app_id) or (filter in app_info_dict['manifest']['name']))) or not filter:
-                    app_installed = _is_installed(app_id)
-
-                    # Only installed apps filter
-                    if installed and not app_installed:
-                        continue
-
-                    # Filter only apps with backup and restore scripts
-                    if with_backup and (
-                        not os.path.isfile(apps_setting_path + app_id + '/scripts/backup') or
-                        not os.path.isfile(apps_setting_path + app_id + '/scripts/restore')
-                    ):
-                        continue
-
-                    if raw:
-                        app_info_dict['installed'] = app_installed
-                        if app_installed:
-                            app_info_dict['status'] = _get_app_status(app_id)
-                        list_dict[app_id] = app_info_dict
-                    else:
-                        label = None
-                        if app_installed:
-                            app_info_dict_raw = app_info(app=app_id, raw=True)
-                            label = app_info_dict_raw['settings']['label']
-                        list_dict.append({
-                            'id': app_id,
-                            'name': app_info_dict['manifest']['name'],
-                            'label': label,
-                            'description': _value_for_locale(
-                                app_info_dict['manifest']['description']),
-                            # FIXME: Temporarly allow undefined license
-                            'license': app_info_dict['manifest'].get('license',
-                                m18n.n('license_undefined')),
-                            'installed': app_installed
-                        })
-                    i += 1
+                custom_apps[app] = {"manifest":json.loads(str(json_manifest.read()))}
+            custom_apps[app]['repository'] = None
+            app_entries[app] = [custom_apps[app]['manifest']['name']]
+
+    # Select apps to list
+    selected_apps = []
+    for app_id in sorted(app_entries.keys())[offset:]:
+        if len(selected_apps) >= limit:
+            break
+        app_name = app_entries[app_id][0]
+        if filter and (filter not in app_id) and (filter not in app_name):
+            continue
+        app_installed = _is_installed(app_id)
+
+        # Only installed apps filter
+        if installed and not app_installed:
+            continue
+
+        # Filter only apps with backup and restore scripts
+        if with_backup and (
+            not os.path.isfile(apps_setting_path + app_id + '/scripts/backup') or
+            not os.path.isfile(apps_setting_path + app_id + '/scripts/restore')
+        ):
+            continue
+        selected_apps.append((app_id, app_installed))
+
+    # Resolve selected installed apps info at once
+    installed_apps_info = _get_installed_apps_info(
+        [app_id for app_id, app_installed in selected_apps if app_installed],
+        index=index)
+
+    apps_info = OrderedDict()
+    with open(appslist_index) as catalog:
+        for app_id, app_installed in selected_apps:
+            if app_id in custom_apps:
+                apps_info[app_id] = custom_apps[app_id]
             else:
-               break
+                apps_info[app_id] = _read_appslist_index_entry(
+                    index, catalog, app_entries[app_id])
+
+    # Check the requirements of the selected apps at once
+    apps_installable = _check_apps_requirements(dict(
+        (app_id, info['manifest']) for app_id, info in apps_info.items()))
+
+    for app_id, app_installed in selected_apps:
+        app_info_dict = apps_info[app_id]
+        if raw:
+            app_info_dict['installed'] = app_installed
+            app_info_dict['installable'] = apps_installable[app_id]
+            if app_installed:
+                app_info_dict['status'] = \
+                    installed_apps_info[app_id]['status']
+            list_dict[app_id] = app_info_dict
+        else:
+            label = None
+            if app_installed:
+                label = installed_apps_info[app_id]['label']
+            list_dict.append({
+                'id': app_id,
+                'name': app_info_dict['manifest']['name'],
+                'label': label,
+                'description': _value_for_locale(
+                    app_info_dict['manifest']['description']),
+                # FIXME: Temporarly allow undefined license
+                'license': app_info_dict['manifest'].get('license',
+                    m18n.n('license_undefined')),
+                'installed': app_installed,
+                'installable': apps_installable[app_id],
+            })
     if not raw:
         list_dict = { 'apps': list_dict }
     return list_dict
@@ -247,8 +356,14 @@ def app_info(app, show_status=False, raw=False):
         raise MoulinetteError(errno.EINVAL,
                               m18n.n('app_not_installed', app=app))
     if raw:
-        ret = app_list(filter=app, raw=True)[app]
-        ret['settings'] = _get_app_settings(app)
+        info = _get_installed_apps_info([app])[app]
+        ret = info['appslist_info'] or {
+            'manifest': info['manifest'],
+            'repository': None,
+        }
+        ret['installed'] = True
+        ret['status'] = info['status']
+        ret['settings'] = info['settings']
         return ret
 
     app_setting_path = apps_setting_path + app
@@ -272,7 +387,7 @@ def app_info(app, show_status=False, raw=False):
     return info
 
 
-def app_map(app=None, raw=False, user=None):
+def app_map(app=None, raw=False, user=None, domain=None):
     """
     List apps by domain
 
@@ -280,11 +395,32 @@ def app_map(app=None, raw=False, user=None):
         user -- Allowed app map for a user
         raw -- Return complete dict
         app -- Specific app to map
+        domain -- Specific domain to map
 
     """
     apps = []
     result = {}
 
+    # Answer from the apps locations index unless users access is needed
+    if user is None:
+        if app is not None and not _is_installed(app):
+            raise MoulinetteError(errno.EINVAL,
+                                  m18n.n('app_not_installed', app=app))
+        index = _get_locations_index()
+        for app_id, location in index['apps'].items():
+            if location is None or (app is not None and app_id != app) \
+                    or (domain is not None and location[0] != domain):
+                continue
+            app_domain, path, label = location
+            if raw:
+                result.setdefault(app_domain, {})[path] = {
+                    'label': label,
+                    'id': app_id
+                }
+            else:
+                result[app_domain + path] = label
+        return result
+
     if app is not None:
         if not _is_installed(app):
             raise MoulinetteError(errno.EINVAL,
@@ -300,30 +436,29 @@ def app_map(app=None, raw=False, user=None):
         if 'domain' not in app_settings:
             continue
         if user is not None:
-            if ('mode' not in app_settings \
-                    or ('mode' in app_settings \
-                        and app_settings['mode'] == 'private')) \
-                and 'allowed_users' in app_settings \
-                and user not in app_settings['allowed_users'].split(','):
+            allowed_users = _get_app_allowed_users(app_settings)
+            if allowed_users is not None and user not in allowed_users:
                 continue
 
-        domain = app_settings['domain']
+        app_domain = app_settings['domain']
         path = app_settings.get('path', '/')
+        if domain is not None and app_domain != domain:
+            continue
 
         if raw:
-            if domain not in result:
-                result[domain] = {}
-            result[domain][path] = {
+            if app_domain not in result:
+                result[app_domain] = {}
+            result[app_domain][path] = {
                 'label': app_settings['label'],
                 'id': app_settings['id']
             }
         else:
-            result[domain + path] = app_settings['label']
+            result[app_domain + path] = app_settings['label']
 
     return result
 
 
-def app_upgrade(auth, app=[], url=None, file=None):
+def app_upgrade(auth, app=[], url=None, file=None, jobs=None):
     """
     Upgrade app
 
@@ -331,17 +466,14 @@ def app_upgrade(auth, app=[], url=None, file=None):
         file -- Folder or tarball for upgrade
         app -- App(s) to upgrade (default all)
         url -- Git url to fetch for upgrade
+        jobs -- Number of upgrade scripts to run in parallel
 
     """
-    from yunohost.hook import hook_add, hook_remove, hook_exec
-
     try:
-        app_list()
+        upgrade_candidates = _get_upgrades_index()
     except MoulinetteError:
         raise MoulinetteError(errno.ENODATA, m18n.n('app_no_upgrade'))
 
-    upgraded_apps = []
-
     # If no app is specified, upgrade all apps
     if not app:
         if (not url and not file):
@@ -349,88 +481,103 @@ def app_upgrade(auth, app=[], url=None, file=None):
     elif not isinstance(app, list):
         app = [ app ]
 
+    # Retrieve apps to upgrade and from where to get their sources
+    upgrades = OrderedDict()
     for app_instance_name in app:
         installed = _is_installed(app_instance_name)
         if not installed:
             raise MoulinetteError(errno.ENOPKG,
                                   m18n.n('app_not_installed', app=app_instance_name))
 
-        if app_instance_name in upgraded_apps:
+        if app_instance_name in upgrades:
             continue
 
-        current_app_dict = app_info(app_instance_name,  raw=True)
-        new_app_dict     = app_info(app_instance_name, raw=True)
-
         if file:
-            manifest = _extract_app_from_file(file)
+            source = (_extract_app_from_file, file)
         elif url:
-            manifest = _fetch_app_from_git(url)
-        elif new_app_dict is None or 'lastUpdate' not in new_app_dict or 'git' not in new_app_dict:
-            logger.warning(m18n.n('custom_app_url_required', app=app_instance_name))
-            continue
-        elif (new_app_dict['lastUpdate'] > current_app_dict['lastUpdate']) \
-              or ('update_time' not in current_app_dict['settings'] \
-                   and (new_app_dict['lastUpdate'] > current_app_dict['settings']['install_time'])) \
-              or ('update_time' in current_app_dict['settings'] \
-                   and (new_app_dict['lastUpdate'] > current_app_dict['settings']['update_time'])):
-            manifest = _fetch_app_from_git(app_instance_name)
+            source = (_fetch_app_from_git, url)
         else:
-            continue
+            candidate = upgrade_candidates['apps'][app_instance_name]
+            if candidate['lastUpdate'] is None:
+                logger.warning(m18n.n('custom_app_url_required', app=app_instance_name))
+                continue
+            elif candidate['upgradable']:
+                source = (_fetch_app_from_git, app_instance_name)
+            else:
+                continue
+        upgrades[app_instance_name] = source + (
+            _get_app_settings(app_instance_name),)
 
-        # Check requirements
-        _check_manifest_requirements(manifest)
-
-        app_setting_path = apps_setting_path +'/'+ app_instance_name
-
-        # Retrieve current app status
-        status = _get_app_status(app_instance_name)
-        status['remote'] = manifest.get('remote', None)
-
-        # Clean hooks and add new ones
-        hook_remove(app_instance_name)
-        if 'hooks' in os.listdir(app_tmp_folder):
-            for hook in os.listdir(app_tmp_folder +'/hooks'):
-                hook_add(app_instance_name, app_tmp_folder +'/hooks/'+ hook)
-
-        # Retrieve arguments list for upgrade script
-        # TODO: Allow to specify arguments
-        args_odict = _parse_args_from_manifest(manifest, 'upgrade', auth=auth)
-        args_list = args_odict.values()
-        args_list.append(app_instance_name)
-
-        # Prepare env. var. to pass to script
-        env_dict = _make_environment_dict(args_odict)
-        app_id, app_instance_nb = _parse_app_instance_name(app_instance_name)
-        env_dict["YNH_APP_ID"] = app_id
-        env_dict["YNH_APP_INSTANCE_NAME"] = app_instance_name
-        env_dict["YNH_APP_INSTANCE_NUMBER"] = str(app_instance_nb)
-
-        # Execute App upgrade script
-        os.system('chown -hR admin: %s' % install_tmp)
-        if hook_exec(app_tmp_folder +'/scripts/upgrade', args=args_list, env=env_dict) != 0:
-            logger.error(m18n.n('app_upgrade_failed', app=app_instance_name))
-        else:
-            now = int(time.time())
-            # TODO: Move install_time away from app_setting
-            app_setting(app_instance_name, 'update_time', now)
-            status['upgraded_at'] = now
+    if not upgrades:
+        raise MoulinetteError(errno.ENODATA, m18n.n('app_no_upgrade'))
 
-            # Store app status
-            with open(app_setting_path + '/status.json', 'w+') as f:
-                json.dump(status, f)
+    # Fetch or extract sources of all apps concurrently, each one in its
+    # own work directory
+    work_dirs = dict((n, os.path.join(app_upgrade_tmp, n)) for n in upgrades)
 
-            # Replace scripts and manifest
-            os.system('rm -rf "%s/scripts" "%s/manifest.json"' % (app_setting_path, app_setting_path))
-            os.system('mv "%s/manifest.json" "%s/scripts" %s' % (app_tmp_folder, app_tmp_folder, app_setting_path))
+    def _fetch_sources(app_instance_name):
+        fetch, source, _ = upgrades[app_instance_name]
+        return fetch(source, work_dir=work_dirs[app_instance_name])
 
-            # So much win
-            upgraded_apps.append(app_instance_name)
-            logger.success(m18n.n('app_upgraded', app=app_instance_name))
+    try:
+        pool = ThreadPool(min(len(upgrades), app_fetch_workers))
+        try:
+            manifests = pool.map(_fetch_sources, upgrades.keys())
+        finally:
+            pool.close()
+            pool.join()
+
+        # Prepare upgrades and schedule the ones which share a domain
+        # or an app id to not run together - all requirements and arguments
+        # are checked before any app is altered
+        upgrade_jobs = []
+        for app_instance_name, manifest in zip(upgrades, manifests):
+            work_dir = work_dirs[app_instance_name]
+            settings = upgrades[app_instance_name][2]
+
+            # Check requirements
+            _check_manifest_requirements(manifest)
+
+            # Retrieve current app status
+            status = _get_app_status(app_instance_name)
+            status['remote'] = manifest.get('remote', None)
+
+            # Retrieve arguments list for upgrade script
+            # TODO: Allow to specify arguments
+            args_odict = _parse_args_from_manifest(manifest, 'upgrade', auth=auth)
+            args_list = args_odict.values()
+            args_list.append(app_instance_name)
+
+            # Prepare env. var. to pass to script
+            env_dict = _make_environment_dict(args_odict)
+            app_id, app_instance_nb = _parse_app_instance_name(app_instance_name)
+            env_dict["YNH_APP_ID"] = app_id
+            env_dict["YNH_APP_INSTANCE_NAME"] = app_instance_name
+            env_dict["YNH_APP_INSTANCE_NUMBER"] = str(app_instance_nb)
+
+            keys = set(['app:' + app_id])
+            if settings.get('domain'):
+                keys.add('domain:' + settings['domain'])
+            upgrade_jobs.append((keys, _run_app_upgrade_script, (
+                app_instance_name, work_dir, args_list, env_dict, status)))
+
+        # Execute App upgrade scripts
+        for path in (install_tmp, app_upgrade_tmp):
+            set_permissions(path, [{'owner': 'admin'}], recursive=False)
+        for work_dir in work_dirs.values():
+            set_permissions(work_dir, [{'owner': 'admin'}])
+        results = _run_scheduled_jobs(upgrade_jobs, workers=jobs or 1)
+    finally:
+        for work_dir in work_dirs.values():
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-    if not upgraded_apps:
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    if not any(results):
         raise MoulinetteError(errno.ENODATA, m18n.n('app_no_upgrade'))
 
-    app_ssowatconf(auth)
+    _update_ssowatconf(auth, wait=True)
 
     logger.success(m18n.n('upgrade_complete'))
 
@@ -459,7 +606,7 @@ def app_install(auth, app, label=None, args=None):
         },
     }
 
-    if app in app_list(raw=True) or ('@' in app) or ('http://' in app) or ('https://' in app):
+    if app in app_list(filter=app, raw=True) or ('@' in app) or ('http://' in app) or ('https://' in app):
         manifest = _fetch_app_from_git(app)
     elif os.path.exists(app):
         manifest = _extract_app_from_file(app)
@@ -478,15 +625,24 @@ def app_install(auth, app, label=None, args=None):
 
     # Check if app can be forked
     instance_number = _installed_instance_number(app_id, last=True) + 1
-    if instance_number > 1 :
-        if 'multi_instance' not in manifest or not is_true(manifest['multi_instance']):
-            raise MoulinetteError(errno.EEXIST,
-                                  m18n.n('app_already_installed', app=app_id))
-
-        # Change app_id to the forked app id
-        app_instance_name = app_id + '__' + str(instance_number)
-    else:
-        app_instance_name = app_id
+    # Skip instances which are on disk but missing from the registry
+    while True:
+        if instance_number > 1:
+            app_instance_name = app_id + '__' + str(instance_number)
+        else:
+            app_instance_name = app_id
+        if not os.path.exists(os.path.join(apps_setting_path,
+                                           app_instance_name)):
+            break
+        logger.warning("app instance '%s' is missing from the registry",
+                       app_instance_name)
+        _register_app_instance(app_instance_name)
+        instance_number += 1
+
+    if instance_number > 1 and ('multi_instance' not in manifest or
+                                not is_true(manifest['multi_instance'])):
+        raise MoulinetteError(errno.EEXIST,
+                              m18n.n('app_already_installed', app=app_id))
 
     # Retrieve arguments list for install script
     args_dict = {} if not args else \
@@ -503,9 +659,16 @@ def app_install(auth, app, label=None, args=None):
 
     # Create app directory
     app_setting_path = os.path.join(apps_setting_path, app_instance_name)
-    if os.path.exists(app_setting_path):
-        shutil.rmtree(app_setting_path)
-    os.makedirs(app_setting_path)
+    try:
+        os.makedirs(app_setting_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        # Never clobber the settings of an installed app
+        raise MoulinetteError(errno.EEXIST,
+                              m18n.n('app_already_installed',
+                                     app=app_instance_name))
+    _register_app_instance(app_instance_name)
 
     # Clean hooks and add new ones
     hook_remove(app_instance_name)
@@ -522,10 +685,10 @@ def app_install(auth, app, label=None, args=None):
     app_settings['install_time'] = status['installed_at']
     _set_app_settings(app_instance_name, app_settings)
 
-    os.system('chown -R admin: '+ app_tmp_folder)
+    set_permissions(install_tmp, [{'owner': 'admin'}], recursive=False)
+    set_permissions(app_tmp_folder, [{'owner': 'admin'}])
 
     # Execute App install script
-    os.system('chown -hR admin: %s' % install_tmp)
     # Move scripts and manifest to the right place
     os.system('cp %s/manifest.json %s' % (app_tmp_folder, app_setting_path))
     os.system('cp -R %s/scripts %s' % (app_tmp_folder, app_setting_path))
@@ -557,6 +720,7 @@ def app_install(auth, app, label=None, args=None):
             hook_remove(app_instance_name)
             shutil.rmtree(app_setting_path)
             shutil.rmtree(app_tmp_folder)
+            _unregister_app_instance(app_instance_name)
 
             if install_retcode == -1:
                 raise MoulinetteError(errno.EINTR,
@@ -569,11 +733,13 @@ def app_install(auth, app, label=None, args=None):
 
     # Clean and set permissions
     shutil.rmtree(app_tmp_folder)
-    os.system('chmod -R 400 %s' % app_setting_path)
-    os.system('chown -R root: %s' % app_setting_path)
-    os.system('chown -R admin: %s/scripts' % app_setting_path)
+    set_permissions(app_setting_path, [
+        {'owner': 'root', 'mode': 0400},
+        {'path': 'scripts', 'owner': 'admin', 'mode': 0400},
+    ])
+    _invalidate_upgrades_index(app_instance_name)
 
-    app_ssowatconf(auth)
+    _update_ssowatconf(auth, wait=True)
 
     logger.success(m18n.n('installation_complete'))
 
@@ -599,9 +765,15 @@ def app_remove(auth, app):
         shutil.rmtree('/tmp/yunohost_remove')
     except: pass
 
-    os.system('cp -a %s /tmp/yunohost_remove && chown -hR admin: /tmp/yunohost_remove' % app_setting_path)
-    os.system('chown -R admin: /tmp/yunohost_remove')
-    os.system('chmod -R u+rX /tmp/yunohost_remove')
+    # Move the scripts and the manifest out of the settings directory - which
+    # is removed afterwards - so that the admin user can access them, while
+    # the settings stay available to the script
+    os.makedirs('/tmp/yunohost_remove')
+    for name in ('scripts', 'manifest.json'):
+        if os.path.exists(os.path.join(app_setting_path, name)):
+            shutil.move(os.path.join(app_setting_path, name),
+                        os.path.join('/tmp/yunohost_remove', name))
+    set_permissions('/tmp/yunohost_remove', [{'owner': 'admin', 'mode': 'u+rX'}])
 
     args_list = [app]
 
@@ -611,7 +783,10 @@ def app_remove(auth, app):
     if os.path.exists(app_setting_path): shutil.rmtree(app_setting_path)
     shutil.rmtree('/tmp/yunohost_remove')
     hook_remove(app)
-    app_ssowatconf(auth)
+    _unregister_app_instance(app)
+    _invalidate_upgrades_index(app)
+    _update_locations_index(app, None)
+    _update_ssowatconf(auth, wait=True)
 
 
 def app_addaccess(auth, apps, users=[]):
@@ -635,36 +810,37 @@ def app_addaccess(auth, apps, users=[]):
     if not isinstance(apps, list):
         apps = [apps,]
 
-    for app in apps:
-        app_settings = _get_app_settings(app)
-        if not app_settings:
-            continue
-
-        if 'mode' not in app_settings:
-            app_setting(app, 'mode', 'private')
-            app_settings['mode'] = 'private'
-
-        if app_settings['mode'] == 'private':
-            allowed_users = set()
-            if 'allowed_users' in app_settings:
-                allowed_users = set(app_settings['allowed_users'].split(','))
-
-            for allowed_user in users:
-                if allowed_user not in allowed_users:
-                    try:
-                        user_info(auth, allowed_user)
-                    except MoulinetteError:
-                        logger.warning(m18n.n('user_unknown', user=allowed_user))
-                        continue
-                    allowed_users.add(allowed_user)
+    # Update SSOwat configuration once all apps have been processed
+    with _ssowatconf_batch(auth):
+        for app in apps:
+            app_settings = _get_app_settings(app)
+            if not app_settings:
+                continue
 
-            new_users = ','.join(allowed_users)
-            app_setting(app, 'allowed_users', new_users)
-            hook_callback('post_app_addaccess', args=[app, new_users])
+            if 'mode' not in app_settings:
+                app_setting(app, 'mode', 'private')
+                app_settings['mode'] = 'private'
+
+            if app_settings['mode'] == 'private':
+                allowed_users = set()
+                if 'allowed_users' in app_settings:
+                    allowed_users = set(app_settings['allowed_users'].split(','))
+
+                for allowed_user in users:
+                    if allowed_user not in allowed_users:
+                        try:
+                            user_info(auth, allowed_user)
+                        except MoulinetteError:
+                            logger.warning(m18n.n('user_unknown', user=allowed_user))
+                            continue
+                        allowed_users.add(allowed_user)
 
-            result[app] = allowed_users
+                new_users = ','.join(allowed_users)
+                app_setting(app, 'allowed_users', new_users)
+                hook_callback('post_app_addaccess', args=[app, new_users])
+                _update_ssowatconf(auth)
 
-    app_ssowatconf(auth)
+                result[app] = allowed_users
 
     return { 'allowed_users': result }
 
@@ -691,31 +867,32 @@ def app_removeaccess(auth, apps, users=[]):
     if not isinstance(apps, list):
         apps = [apps,]
 
-    for app in apps:
-        app_settings = _get_app_settings(app)
-        if not app_settings:
-            continue
-        allowed_users = set()
-
-        if app_settings.get('skipped_uris', '') != '/':
-            if remove_all:
-                pass
-            elif 'allowed_users' in app_settings:
-                for allowed_user in app_settings['allowed_users'].split(','):
-                    if allowed_user not in users:
-                        allowed_users.add(allowed_user)
-            else:
-                for allowed_user in user_list(auth)['users'].keys():
-                    if allowed_user not in users:
-                        allowed_users.add(allowed_user)
+    # Update SSOwat configuration once all apps have been processed
+    with _ssowatconf_batch(auth):
+        for app in apps:
+            app_settings = _get_app_settings(app)
+            if not app_settings:
+                continue
+            allowed_users = set()
 
-            new_users = ','.join(allowed_users)
-            app_setting(app, 'allowed_users', new_users)
-            hook_callback('post_app_removeaccess', args=[app, new_users])
+            if app_settings.get('skipped_uris', '') != '/':
+                if remove_all:
+                    pass
+                elif 'allowed_users' in app_settings:
+                    for allowed_user in app_settings['allowed_users'].split(','):
+                        if allowed_user not in users:
+                            allowed_users.add(allowed_user)
+                else:
+                    for allowed_user in user_list(auth)['users'].keys():
+                        if allowed_user not in users:
+                            allowed_users.add(allowed_user)
 
-            result[app] = allowed_users
+                new_users = ','.join(allowed_users)
+                app_setting(app, 'allowed_users', new_users)
+                hook_callback('post_app_removeaccess', args=[app, new_users])
+                _update_ssowatconf(auth)
 
-    app_ssowatconf(auth)
+                result[app] = allowed_users
 
     return { 'allowed_users': result }
 
@@ -732,20 +909,21 @@ def app_clearaccess(auth, apps):
 
     if not isinstance(apps, list): apps = [apps]
 
-    for app in apps:
-        app_settings = _get_app_settings(app)
-        if not app_settings:
-            continue
-
-        if 'mode' in app_settings:
-            app_setting(app, 'mode', delete=True)
+    # Update SSOwat configuration once all apps have been processed
+    with _ssowatconf_batch(auth):
+        for app in apps:
+            app_settings = _get_app_settings(app)
+            if not app_settings:
+                continue
 
-        if 'allowed_users' in app_settings:
-            app_setting(app, 'allowed_users', delete=True)
+            if 'mode' in app_settings:
+                app_setting(app, 'mode', delete=True)
 
-        hook_callback('post_app_clearaccess', args=[app])
+            if 'allowed_users' in app_settings:
+                app_setting(app, 'allowed_users', delete=True)
 
-    app_ssowatconf(auth)
+            hook_callback('post_app_clearaccess', args=[app])
+            _update_ssowatconf(auth)
 
 
 def app_debug(app):
@@ -791,7 +969,7 @@ def app_makedefault(auth, app, domain=None):
     elif domain not in domain_list(auth)['domains']:
         raise MoulinetteError(errno.EINVAL, m18n.n('domain_unknown'))
 
-    if '/' in app_map(raw=True)[domain]:
+    if _find_app_locations(domain, '/')[0]:
         raise MoulinetteError(errno.EEXIST,
                               m18n.n('app_location_already_used'))
 
@@ -844,6 +1022,116 @@ def app_setting(app, key, value=None, delete=False):
         _set_app_settings(app, app_settings)
 
 
+def app_settings_bulk(app, get=None, values=None, delete=None, shell=False):
+    """
+    Get, set or delete several app settings at once
+
+    Settings are set and deleted in a single read-modify-write of the app
+    settings file. Given settings are returned after that, or all of them
+    if no action is requested.
+
+    Keyword argument:
+        app -- App ID
+        get -- Keys of the settings to get
+        values -- Settings to set as key=value pairs
+        delete -- Keys of the settings to delete
+        shell -- Return settings as shell variables assignments
+
+    """
+    app_settings = _get_app_settings(app) or {}
+
+    if values or delete:
+        for setting in values or []:
+            if '=' not in setting:
+                raise MoulinetteError(errno.EINVAL,
+                    m18n.n('app_setting_invalid', setting=setting))
+            key, value = setting.split('=', 1)
+            # FIXME: Allow multiple values for some keys?
+            if key in ['redirected_urls','redirected_regex']:
+                value = yaml.load(value)
+            app_settings[key] = value
+        for key in delete or []:
+            app_settings.pop(key, None)
+        _set_app_settings(app, app_settings)
+
+    if get:
+        result = OrderedDict((k, app_settings.get(k, None)) for k in get)
+    elif not values and not delete:
+        result = OrderedDict(sorted(app_settings.items()))
+    else:
+        return
+
+    if shell:
+        return _format_shell_assignments(result)
+    return result
+
+
+def app_cache(prune=False, max_size=None):
+    """
+    Show or prune the cache of apps git repositories and sources archives
+
+    Keyword argument:
+        prune -- Remove least recently used repositories and archives to
+            fit the size
+        max_size -- Maximum size of each cache in MB when pruning
+
+    """
+    if prune:
+        if max_size is None:
+            removed = _prune_git_cache(git_cache_max_size)
+            removed_archives = _prune_archive_store(archive_store_max_size)
+        else:
+            max_size = int(max_size) * 1024 * 1024
+            removed = _prune_git_cache(max_size)
+            removed_archives = _prune_archive_store(max_size)
+        logger.success(m18n.n('app_cache_pruned', repositories=len(removed),
+                              archives=len(removed_archives)))
+
+    repositories = []
+    for mirror in _get_git_cache_mirrors():
+        try:
+            url = subprocess.check_output([
+                'git', 'config', '--get', 'remote.origin.url'
+                ], cwd=mirror['path']).strip()
+        except (subprocess.CalledProcessError, OSError):
+            url = None
+        repositories.append({
+            'url': url,
+            'size': mirror['size'],
+            'last_used': mirror['last_used'],
+        })
+    archives = _get_archive_store_objects()
+
+    return {
+        'repositories': repositories,
+        'archives': {
+            'count': len(archives),
+            'size': sum(a['size'] for a in archives),
+        },
+        'size': sum(r['size'] for r in repositories + archives),
+    }
+
+
+def app_instances(rebuild=False):
+    """
+    List instance numbers of installed apps
+
+    Keyword argument:
+        rebuild -- Rebuild the registry from installed apps
+
+    """
+    if rebuild:
+        with _instances_registry_transaction() as registry:
+            registry.clear()
+            registry.update(_scan_app_instances())
+        logger.success(m18n.n('app_instances_rebuilt'))
+    else:
+        registry = _get_instances_registry()
+
+    return {'instances': dict(
+        (app_id, sorted(numbers)) for app_id, numbers in registry.items())}
+
+
 def app_checkport(port):
     """
     Check availability of a local port
@@ -890,23 +1178,22 @@ def app_checkurl(auth, url, app=None):
     if path[-1:] != '/':
         path = path + '/'
 
-    apps_map = app_map(raw=True)
-
     if domain not in domain_list(auth)['domains']:
         raise MoulinetteError(errno.EINVAL, m18n.n('domain_unknown'))
 
-    if domain in apps_map:
-        for p, a in apps_map[domain].items():
-            # Skip requested app checking
-            if app is not None and a['id'] == app:
-                installed = True
-                continue
-            if path == p:
-                raise MoulinetteError(errno.EINVAL,
-                                      m18n.n('app_location_already_used'))
-            elif path.startswith(p) and p.count('/') < path.count('/'):
-                raise MoulinetteError(errno.EPERM,
-                                      m18n.n('app_location_install_failed'))
+    # Skip requested app checking
+    if app is not None:
+        location = _get_locations_index()['apps'].get(app)
+        installed = location is not None and location[0] == domain
+    exclude = [app] if installed else []
+
+    used, parents = _find_app_locations(domain, path, exclude=exclude)
+    if used:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('app_location_already_used'))
+    elif parents:
+        raise MoulinetteError(errno.EPERM,
+                              m18n.n('app_location_install_failed'))
 
     if app is not None and not installed:
         app_setting(app, 'domain', value=domain)
@@ -955,15 +1242,250 @@ def app_ssowatconf(auth):
     from yunohost.domain import domain_list
     from yunohost.user import user_list
 
+    if _ssowatconf_batch_state['depth'] > 0:
+        _ssowatconf_batch_state['full'] = True
+        return
+
     with open('/etc/yunohost/current_host', 'r') as f:
         main_domain = f.readline().rstrip()
 
     domains = domain_list(auth)['domains']
 
-    users = {}
-    for username in user_list(auth)['users'].keys():
-        users[username] = app_map(user=username)
+    # Load all apps settings once and build users map from them
+    apps_settings = _get_installed_apps_settings()
+    users = _build_users_apps_map(
+        apps_settings, user_list(auth)['users'].keys())
+
+    _save_ssowat_conf(
+        _build_ssowat_conf(main_domain, domains, users, apps_settings))
+
+    logger.success(m18n.n('ssowat_conf_generated'))
+
+
+def _update_ssowatconf(auth, user=None, user_deleted=False, wait=False):
+    """
+    Request an update of SSOwat configuration file for a change
+
+    Only the part of the current configuration affected by the change is
+    updated: the entry of the given user if any, or the rules and users
+    map which come from apps settings otherwise - i.e. after an app has
+    been installed, upgraded, removed or its access changed.
+
+    Within a batch - see _ssowatconf_batch - the change is deferred until
+    the batch ends. If a regeneration window is set, the change is queued
+    and all changes requested during the window - by any process - are
+    applied at once at its end by a detached process.
+
+    Keyword arguments:
+        user -- The username which has been created, updated or deleted
+        user_deleted -- Whether the user has been deleted
+        wait -- Wait for the change to be applied
+
+    """
+    change = {'user': user, 'user_deleted': user_deleted}
+
+    if _ssowatconf_batch_state['depth'] > 0:
+        _ssowatconf_batch_state['changes'].append(change)
+        return
+
+    window = _get_ssowatconf_regen_window()
+    if not window:
+        _apply_ssowatconf_changes(auth, [change])
+        return
+
+    _push_ssowatconf_queue([change])
+    if wait:
+        _flush_ssowatconf_queue(auth, blocking=True)
+    else:
+        _spawn_ssowatconf_flusher(window)
+
+
+@contextmanager
+def _ssowatconf_batch(auth):
+    """
+    Defer SSOwat configuration updates until the end of the block
+
+    All changes requested by _update_ssowatconf within the block - which
+    can be nested - are applied at once when the outermost one ends, or
+    the configuration is regenerated once if app_ssowatconf has been
+    called within it.
+
+    Keyword arguments:
+        auth -- The authenticator to use to apply the changes
+
+    """
+    state = _ssowatconf_batch_state
+    state['depth'] += 1
+    try:
+        yield
+    finally:
+        state['depth'] -= 1
+        if state['depth'] == 0:
+            changes, full = state['changes'], state['full']
+            state['changes'], state['full'] = [], False
+            if full:
+                app_ssowatconf(auth)
+            elif changes:
+                _apply_ssowatconf_changes(auth, changes)
+
+
+def _get_ssowatconf_regen_window():
+    """
+    Return the time in seconds during which SSOwat configuration changes
+    are coalesced, as set by the YNH_SSOWAT_REGEN_WINDOW env. variable
+
+    """
+    try:
+        return max(float(os.environ.get('YNH_SSOWAT_REGEN_WINDOW', 0)), 0)
+    except ValueError:
+        logger.warning("invalid SSOwat regeneration window '%s', ignoring",
+                       os.environ['YNH_SSOWAT_REGEN_WINDOW'])
+        return 0
+
+
+def _push_ssowatconf_queue(changes):
+    """Append changes to the SSOwat configuration changes queue"""
+    with open(ssowat_regen_queue, 'a') as queue:
+        fcntl.flock(queue, fcntl.LOCK_EX)
+        for change in changes:
+            queue.write(json.dumps(change) + '\n')
+
+
+def _flush_ssowatconf_queue(auth, delay=0, blocking=False):
+    """
+    Apply queued SSOwat configuration changes
+
+    Only one process flushes the queue at once, until it is empty. The
+    flush lock is released while holding the queue one, so that a change
+    queued after the last check will be flushed by its requester.
+
+    Keyword arguments:
+        auth -- The authenticator to use, if any
+        delay -- Time to wait before the first flush
+        blocking -- Wait for the process flushing the queue, if any
+
+    Returns:
+        False if the queue is already being flushed and blocking is False
+
+    """
+    with open(ssowat_regen_queue + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            return False
+        if delay:
+            time.sleep(delay)
+        while True:
+            with open(ssowat_regen_queue, 'a+') as queue:
+                fcntl.flock(queue, fcntl.LOCK_EX)
+                queue.seek(0)
+                changes = [json.loads(l) for l in queue if l.strip()]
+                queue.truncate(0)
+                if not changes:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    return True
+            logger.debug("applying %d queued SSOwat configuration changes",
+                         len(changes))
+            _apply_ssowatconf_changes(auth, changes)
+
+
+def _spawn_ssowatconf_flusher(delay):
+    """
+    Flush SSOwat configuration changes queue after a delay in a detached
+    process, unless it is already being flushed
+
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        _flush_ssowatconf_queue(None, delay=delay)
+    except:
+        logger.exception("unable to flush SSOwat configuration changes")
+    finally:
+        os._exit(0)
+
+
+def _apply_ssowatconf_changes(auth, changes):
+    """
+    Apply SSOwat configuration changes at once
+
+    Domains and users are taken from the current configuration instead of
+    LDAP. If it can not be reused, the whole configuration is regenerated.
+
+    Keyword arguments:
+        auth -- The authenticator to use to regenerate the configuration,
+            or None to do it in another process
+        changes -- List of changes as requested by _update_ssowatconf
+
+    """
+    with open('/etc/yunohost/current_host', 'r') as f:
+        main_domain = f.readline().rstrip()
+
+    conf_dict = _get_ssowat_conf()
+    if not conf_dict or conf_dict.get('portal_domain') != main_domain \
+            or 'domains' not in conf_dict or 'users' not in conf_dict:
+        logger.debug("unable to update SSOwat configuration, "
+                     "regenerating it")
+        if auth is None:
+            os.system('yunohost app ssowatconf > /dev/null 2>&1')
+        else:
+            app_ssowatconf(auth)
+        return
+
+    # Collapse changes - the last one for a user wins
+    apps_changed = False
+    users_changes = OrderedDict()
+    for change in changes:
+        if change['user'] is None:
+            apps_changed = True
+        else:
+            users_changes[change['user']] = change['user_deleted']
+
+    apps_settings = _get_installed_apps_settings()
+    users = dict(conf_dict['users'])
+    for user, deleted in users_changes.items():
+        if deleted:
+            users.pop(user, None)
+        elif not apps_changed:
+            users.update(_build_users_apps_map(apps_settings, [user]))
+        else:
+            users[user] = {}
+
+    if apps_changed:
+        users = _build_users_apps_map(apps_settings, users.keys())
+        new_conf_dict = _build_ssowat_conf(
+            main_domain, conf_dict['domains'], users, apps_settings)
+    else:
+        new_conf_dict = dict(conf_dict, users=users)
+
+    if new_conf_dict != conf_dict:
+        _save_ssowat_conf(new_conf_dict)
+
+    logger.success(m18n.n('ssowat_conf_generated'))
+
 
+def _build_ssowat_conf(main_domain, domains, users, apps_settings):
+    """
+    Build the SSOwat configuration
+
+    Keyword arguments:
+        main_domain -- The main domain, which serves the portal
+        domains -- List of domains
+        users -- A dict of allowed apps map by username
+        apps_settings -- A dict of settings by app id
+
+    Returns:
+        The SSOwat configuration dict
+
+    """
     skipped_urls = []
     skipped_regex = []
     unprotected_urls = []
@@ -973,47 +1495,38 @@ def app_ssowatconf(auth):
     redirected_regex = { main_domain +'/yunohost[\/]?$': 'https://'+ main_domain +'/yunohost/sso/' }
     redirected_urls ={}
 
-    apps = {}
-    try:
-        apps_list = app_list()['apps']
-    except:
-        apps_list = []
-
     def _get_setting(settings, name):
         s = settings.get(name, None)
         return s.split(',') if s else []
 
-    for app in apps_list:
-        if _is_installed(app['id']):
-            with open(apps_setting_path + app['id'] +'/settings.yml') as f:
-                app_settings = yaml.load(f)
-                for item in _get_setting(app_settings, 'skipped_uris'):
-                    if item[-1:] == '/':
-                        item = item[:-1]
-                    skipped_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
-                for item in _get_setting(app_settings, 'skipped_regex'):
-                    skipped_regex.append(item)
-                for item in _get_setting(app_settings, 'unprotected_uris'):
-                    if item[-1:] == '/':
-                        item = item[:-1]
-                    unprotected_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
-                for item in _get_setting(app_settings, 'unprotected_regex'):
-                    unprotected_regex.append(item)
-                for item in _get_setting(app_settings, 'protected_uris'):
-                    if item[-1:] == '/':
-                        item = item[:-1]
-                    protected_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
-                for item in _get_setting(app_settings, 'protected_regex'):
-                    protected_regex.append(item)
-                if 'redirected_urls' in app_settings:
-                    redirected_urls.update(app_settings['redirected_urls'])
-                if 'redirected_regex' in app_settings:
-                    redirected_regex.update(app_settings['redirected_regex'])
+    for app_settings in apps_settings.values():
+        for item in _get_setting(app_settings, 'skipped_uris'):
+            if item[-1:] == '/':
+                item = item[:-1]
+            skipped_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
+        for item in _get_setting(app_settings, 'skipped_regex'):
+            skipped_regex.append(item)
+        for item in _get_setting(app_settings, 'unprotected_uris'):
+            if item[-1:] == '/':
+                item = item[:-1]
+            unprotected_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
+        for item in _get_setting(app_settings, 'unprotected_regex'):
+            unprotected_regex.append(item)
+        for item in _get_setting(app_settings, 'protected_uris'):
+            if item[-1:] == '/':
+                item = item[:-1]
+            protected_urls.append(app_settings['domain'] + app_settings['path'][:-1] + item)
+        for item in _get_setting(app_settings, 'protected_regex'):
+            protected_regex.append(item)
+        if 'redirected_urls' in app_settings:
+            redirected_urls.update(app_settings['redirected_urls'])
+        if 'redirected_regex' in app_settings:
+            redirected_regex.update(app_settings['redirected_regex'])
 
     for domain in domains:
         skipped_urls.extend([domain + '/yunohost/admin', domain + '/yunohost/api'])
 
-    conf_dict = {
+    return {
         'portal_domain': main_domain,
         'portal_path': '/yunohost/sso/',
         'additional_headers': {
@@ -1034,55 +1547,821 @@ def app_ssowatconf(auth):
         'users': users,
     }
 
-    with open('/etc/ssowat/conf.json', 'w+') as f:
-        json.dump(conf_dict, f, sort_keys=True, indent=4)
 
-    logger.success(m18n.n('ssowat_conf_generated'))
+def _get_ssowat_conf():
+    """Return the current SSOwat configuration, or None if unavailable"""
+    try:
+        with open(ssowat_conf_path) as f:
+            return json.loads(str(f.read()))
+    except (IOError, ValueError):
+        logger.debug("unable to load SSOwat configuration", exc_info=1)
+        return None
 
 
-def _get_app_settings(app_id):
+def _save_ssowat_conf(conf_dict):
     """
-    Get settings of an installed app
+    Write atomically the SSOwat configuration
 
     Keyword arguments:
-        app_id -- The app id
+        conf_dict -- The SSOwat configuration dict
 
     """
-    if not _is_installed(app_id):
-        raise MoulinetteError(errno.EINVAL,
-                              m18n.n('app_not_installed', app=app_id))
-    try:
-        with open(os.path.join(
-                apps_setting_path, app_id, 'settings.yml')) as f:
-            settings = yaml.load(f)
-        if app_id == settings['id']:
-            return settings
-    except (IOError, TypeError, KeyError):
-        logger.exception(m18n.n('app_not_correctly_installed',
-                                app=app_id))
-    return {}
+    tmp_path = ssowat_conf_path + '.tmp'
+    with open(tmp_path, 'w+') as f:
+        json.dump(conf_dict, f, sort_keys=True, indent=4)
+    os.rename(tmp_path, ssowat_conf_path)
 
 
-def _set_app_settings(app_id, settings):
+def _get_registered_appslists():
     """
-    Set settings of an app
-
-    Keyword arguments:
-        app_id -- The app id
-        settings -- Dict with app settings
+    Return the URL of the official list and of each list which is fetched
+    periodically, by name
 
     """
-    with open(os.path.join(
-            apps_setting_path, app_id, 'settings.yml'), 'w') as f:
-        yaml.safe_dump(settings, f, default_flow_style=False)
+    appslists = OrderedDict([
+        ('yunohost', 'https://app.yunohost.org/official.json'),
+    ])
+    for cron_file in sorted(glob.iglob('/etc/cron.d/yunohost-applist-*')):
+        try:
+            with open(cron_file) as f:
+                match = re_appslist_cron.search(f.read())
+        except IOError:
+            continue
+        if match:
+            appslists[match.group('name')] = match.group('url')
+    return appslists
 
 
-def _get_app_status(app_id, format_date=False):
+def _fetch_appslist(name, url):
     """
-    Get app status or create it if needed
+    Fetch an apps list only if it has been modified since the last fetch
+
+    The ETag and Last-Modified headers of the last response are stored in
+    the repository with the list and sent back to the server.
 
     Keyword arguments:
-        app_id -- The app id
+        name -- Name of the list
+        url -- URL of remote JSON list
+
+    Returns:
+        True if the list has been modified
+
+    """
+    list_file = '%s/%s.json' % (repo_path, name)
+    validators_file = '%s/%s.validators' % (repo_path, name)
+
+    headers = {'Accept-Encoding': 'gzip'}
+    if os.path.isfile(list_file):
+        try:
+            with open(validators_file) as f:
+                validators = json.load(f)
+        except (IOError, ValueError):
+            validators = {}
+        if validators.get('url') == url:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        r = requests.get(url, headers=headers, timeout=30)
+    except requests.RequestException:
+        logger.debug("unable to retrieve the apps list '%s' from %s",
+                     name, url, exc_info=1)
+        raise MoulinetteError(errno.EBADR, m18n.n('appslist_retrieve_error'))
+    if r.status_code == 304:
+        logger.debug("the apps list '%s' has not been modified", name)
+        return False
+    elif r.status_code != 200:
+        logger.debug("unable to retrieve the apps list '%s' from %s: %s",
+                     name, url, r.status_code)
+        raise MoulinetteError(errno.EBADR, m18n.n('appslist_retrieve_error'))
+
+    # Replace the list and store its validators
+    with open('%s/%s.tmp' % (repo_path, name), 'w') as f:
+        f.write(r.content)
+    os.rename('%s/%s.tmp' % (repo_path, name), list_file)
+    with open(validators_file, 'w') as f:
+        json.dump({
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }, f)
+    return True
+
+
+def _get_appslists_sources():
+    """
+    Return the modification time and the size of each fetched list
+
+    """
+    sources = {}
+    for applist in app_listlists()['lists']:
+        st = os.stat(os.path.join(repo_path, applist + '.json'))
+        sources[applist] = [st.st_mtime, st.st_size]
+    return sources
+
+
+def _build_appslist_index():
+    """
+    Merge the fetched lists into the apps list index
+
+    The index file starts with a JSON header line which gives, for each
+    app, its name and the location of its info in the rest of the file -
+    the catalog - where the info of all apps are serialized one after
+    the other. It allows to filter apps and to load only some of them
+    without deserializing the whole catalog.
+
+    Returns:
+        The index header
+
+    """
+    try:
+        applists = app_listlists()['lists']
+    except MoulinetteError:
+        applists = []
+
+    header = {'sources': {}, 'apps': {}}
+    catalog = []
+    offset = 0
+
+    for applist in applists:
+        list_file = os.path.join(repo_path, applist + '.json')
+        st = os.stat(list_file)
+        header['sources'][applist] = [st.st_mtime, st.st_size]
+        with open(list_file) as json_list:
+            for app, info in json.loads(str(json_list.read())).items():
+                if app in header['apps']:
+                    continue
+                info['repository'] = applist
+                data = json.dumps(info)
+                header['apps'][app] = [
+                    info.get('manifest', {}).get('name', app),
+                    offset, len(data)
+                ]
+                catalog.append(data)
+                offset += len(data)
+
+    with open(appslist_index + '.tmp', 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        f.write(''.join(catalog))
+    os.rename(appslist_index + '.tmp', appslist_index)
+
+    # Invalidate the loaded index
+    _appslist_index_cache.clear()
+
+    return header
+
+
+def _get_appslist_index():
+    """
+    Return the apps list index header, which is (re)built if a fetched list
+    has changed since its last build
+
+    """
+    sources = _get_appslists_sources()
+    if _appslist_index_cache.get('sources') == sources:
+        return _appslist_index_cache
+
+    header = None
+    try:
+        with open(appslist_index) as f:
+            header = json.loads(f.readline())
+            data_offset = f.tell()
+    except (IOError, ValueError):
+        logger.debug("unable to load the apps list index", exc_info=1)
+    if header is None or header['sources'] != sources:
+        logger.debug("building the apps list index")
+        header = _build_appslist_index()
+        with open(appslist_index) as f:
+            f.readline()
+            data_offset = f.tell()
+
+    _appslist_index_cache.clear()
+    _appslist_index_cache.update(header)
+    _appslist_index_cache['data_offset'] = data_offset
+    return _appslist_index_cache
+
+
+def _read_appslist_index_entry(index, catalog, entry):
+    """
+    Read and return the info of an app from the apps list catalog
+
+    Keyword arguments:
+        index -- The apps list index header
+        catalog -- The opened apps list index file
+        entry -- The app entry in the index header
+
+    """
+    catalog.seek(index['data_offset'] + entry[1])
+    return json.loads(catalog.read(entry[2]))
+
+
+def _get_appslist_entry(index, app_id):
+    """
+    Return the entry of an app - or of its original app for a fork - in
+    the apps list index header, or None if it is not listed
+
+    """
+    if app_id in index['apps']:
+        return index['apps'][app_id]
+    if '__' in app_id:
+        return index['apps'].get(app_id[:app_id.index('__')], None)
+    return None
+
+
+def _get_installed_apps_info(apps=None, index=None):
+    """
+    Resolve the info of installed apps at once
+
+    Retrieve the settings, status, label and manifest of each given
+    installed app - or all of them - and its info from the apps list if
+    any. The apps list index is loaded and opened only once.
+
+    Keyword arguments:
+        apps -- List of app instance names (default all installed apps)
+        index -- The apps list index header to use
+
+    Returns:
+        A dict of info by app instance name, each one containing the keys
+        settings, status, label, manifest and appslist_info
+
+    """
+    if apps is None:
+        apps = os.listdir(apps_setting_path)
+    result = {}
+    if not apps:
+        return result
+    if index is None:
+        index = _get_appslist_index()
+
+    with open(appslist_index) as catalog:
+        for app_id in apps:
+            settings = _get_app_settings(app_id)
+            with open(apps_setting_path + app_id + '/manifest.json') as f:
+                manifest = json.loads(str(f.read()))
+            entry = _get_appslist_entry(index, app_id)
+            result[app_id] = {
+                'settings': settings,
+                'status': _get_app_status(app_id),
+                'label': settings.get('label', None),
+                'manifest': manifest,
+                'appslist_info': _read_appslist_index_entry(
+                    index, catalog, entry) if entry else None,
+            }
+    return result
+
+
+def _get_upgrade_candidate(app_info_dict):
+    """
+    Compare the installed app with its apps list info
+
+    Keyword arguments:
+        app_info_dict -- The app info as returned by _get_installed_apps_info
+
+    Returns:
+        A dict containing the apps list lastUpdate and revision - which are
+        None for a custom app - the time of the app installation or last
+        upgrade and whether the app can be upgraded
+
+    """
+    new_app_dict = app_info_dict['appslist_info']
+    settings = app_info_dict['settings']
+    updated_at = settings.get('update_time', settings.get('install_time'))
+
+    # Custom app
+    if new_app_dict is None or 'lastUpdate' not in new_app_dict \
+            or 'git' not in new_app_dict:
+        return {'lastUpdate': None, 'revision': None,
+                'updated_at': updated_at, 'upgradable': False}
+
+    return {
+        'lastUpdate': new_app_dict['lastUpdate'],
+        'revision': new_app_dict['git'].get('revision'),
+        'updated_at': updated_at,
+        'upgradable': new_app_dict['lastUpdate'] > updated_at,
+    }
+
+
+def _build_upgrades_index(index=None):
+    """
+    Compute the upgrade candidates index from the apps list index
+
+    The index is stored in a JSON file with the apps lists sources it has
+    been built from, and the upgrade candidate of each installed app - see
+    _get_upgrade_candidate.
+
+    Keyword arguments:
+        index -- The apps list index header to use
+
+    Returns:
+        The upgrade candidates index
+
+    """
+    if index is None:
+        index = _get_appslist_index()
+    upgrades = {
+        'sources': index['sources'],
+        'apps': dict((app_id, _get_upgrade_candidate(info)) for app_id, info
+                     in _get_installed_apps_info(index=index).items()),
+    }
+    with _upgrades_index_lock:
+        _write_upgrades_index(upgrades)
+    return upgrades
+
+
+def _write_upgrades_index(upgrades):
+    tmp_path = '%s.%d.tmp' % (upgrades_index, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(upgrades, f)
+    os.rename(tmp_path, upgrades_index)
+
+
+def _get_upgrades_index():
+    """
+    Return the upgrade candidates index
+
+    It is rebuilt if the apps lists have changed since it was computed,
+    and the missing - i.e. invalidated or newly installed - apps are added
+    to it.
+
+    """
+    index = _get_appslist_index()
+    try:
+        with open(upgrades_index) as f:
+            upgrades = json.load(f)
+    except (IOError, ValueError):
+        upgrades = None
+    if upgrades is None or upgrades['sources'] != index['sources']:
+        logger.debug("building the upgrade candidates index")
+        return _build_upgrades_index(index)
+
+    installed = os.listdir(apps_setting_path)
+    missing = [a for a in installed if a not in upgrades['apps']]
+    stale = [a for a in upgrades['apps'] if a not in installed]
+    if missing or stale:
+        for app_id in stale:
+            del upgrades['apps'][app_id]
+        for app_id, info in _get_installed_apps_info(
+                missing, index=index).items():
+            upgrades['apps'][app_id] = _get_upgrade_candidate(info)
+        with _upgrades_index_lock:
+            _write_upgrades_index(upgrades)
+    return upgrades
+
+
+def _invalidate_upgrades_index(app_id):
+    """
+    Remove an app from the upgrade candidates index - to be called once it
+    has been installed, upgraded or removed
+
+    Keyword arguments:
+        app_id -- The app instance name
+
+    """
+    with _upgrades_index_lock:
+        try:
+            with open(upgrades_index) as f:
+                upgrades = json.load(f)
+        except (IOError, ValueError):
+            return
+        if upgrades['apps'].pop(app_id, None) is not None:
+            _write_upgrades_index(upgrades)
+
+
+def _get_app_location(settings):
+    """
+    Return the [domain, path, label] location of an app from its settings,
+    or None if it has no domain
+
+    """
+    if not settings or 'domain' not in settings:
+        return None
+    return [settings['domain'], settings.get('path', '/'),
+            settings.get('label', None)]
+
+
+def _split_app_path(path):
+    """Return the segments of a web path - e.g. ['foo', 'bar'] for /foo/bar/"""
+    return [s for s in path.split('/') if s]
+
+
+def _add_to_locations_trie(index, app_id, location):
+    node = index['domains'].setdefault(location[0], {'apps': [], 'sub': {}})
+    for segment in _split_app_path(location[1]):
+        node = node['sub'].setdefault(segment, {'apps': [], 'sub': {}})
+    node['apps'].append(app_id)
+
+
+def _remove_from_locations_trie(index, app_id, location):
+    trie = index['domains'].get(location[0])
+    nodes = [(None, trie)]
+    for segment in _split_app_path(location[1]):
+        if nodes[-1][1] is None:
+            break
+        nodes.append((segment, nodes[-1][1]['sub'].get(segment)))
+    if nodes[-1][1] is None or app_id not in nodes[-1][1]['apps']:
+        return
+    nodes[-1][1]['apps'].remove(app_id)
+
+    # Prune the emptied nodes up to the domain root
+    while nodes and not nodes[-1][1]['apps'] and not nodes[-1][1]['sub']:
+        segment, _ = nodes.pop()
+        if segment is None:
+            del index['domains'][location[0]]
+        else:
+            del nodes[-1][1]['sub'][segment]
+
+
+def _build_locations_index():
+    """
+    Build the installed apps locations index from their settings
+
+    The index contains the location - see _get_app_location - of each
+    installed app by app id, and a per domain trie of the web path
+    segments used by apps. Each trie node contains the list of the apps
+    installed at its path and its sub-nodes by path segment. The key of
+    the settings file each location comes from is kept by app id, so that
+    settings modified outside of _set_app_settings are detected.
+
+    """
+    index = {'apps': {}, 'domains': {}, 'keys': {}}
+    for app_id in os.listdir(apps_setting_path):
+        _set_app_location(index, app_id, _get_app_settings(app_id))
+    _write_locations_index(index)
+    return index
+
+
+def _get_app_settings_key(app_id):
+    """Return the [inode, mtime, size] of the settings file of an app"""
+    try:
+        st = os.stat(os.path.join(apps_setting_path, app_id, 'settings.yml'))
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime, st.st_size]
+
+
+def _set_app_location(index, app_id, settings):
+    """Set the location of an app in the index from its settings"""
+    previous = index['apps'].get(app_id)
+    if previous is not None:
+        _remove_from_locations_trie(index, app_id, previous)
+    if settings is None:
+        index['apps'].pop(app_id, None)
+        index['keys'].pop(app_id, None)
+        return
+    location = _get_app_location(settings)
+    index['apps'][app_id] = location
+    index['keys'][app_id] = _get_app_settings_key(app_id)
+    if location is not None:
+        _add_to_locations_trie(index, app_id, location)
+
+
+@contextmanager
+def _lock_locations_index():
+    """
+    Hold an exclusive lock on the locations index - between threads and
+    processes - which can be acquired again by the holding thread
+
+    """
+    with _locations_index_lock:
+        state = _locations_index_flock
+        if state['depth'] == 0:
+            lock = open(locations_index + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state['file'] = lock
+        state['depth'] += 1
+        try:
+            yield
+        finally:
+            state['depth'] -= 1
+            if state['depth'] == 0:
+                lock, state['file'] = state['file'], None
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+
+
+def _write_locations_index(index):
+    tmp_path = '%s.%d.tmp' % (locations_index, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_path, locations_index)
+
+    st = os.stat(locations_index)
+    _locations_index_cache.clear()
+    _locations_index_cache.update({
+        'key': (st.st_ino, st.st_mtime, st.st_size), 'index': index})
+
+
+def _get_locations_index():
+    """
+    Return the installed apps locations index, which is built if needed
+    and updated if it does not match the installed apps settings
+
+    """
+    with _lock_locations_index():
+        index = None
+        try:
+            st = os.stat(locations_index)
+        except OSError:
+            pass
+        else:
+            if _locations_index_cache.get('key') == \
+                    (st.st_ino, st.st_mtime, st.st_size):
+                index = _locations_index_cache['index']
+            else:
+                try:
+                    with open(locations_index) as f:
+                        index = json.load(f)
+                except (IOError, ValueError):
+                    pass
+                else:
+                    _locations_index_cache.update({
+                        'key': (st.st_ino, st.st_mtime, st.st_size),
+                        'index': index})
+
+        if index is None:
+            logger.debug("building the apps locations index")
+            return _build_locations_index()
+
+        keys = index.setdefault('keys', {})
+        installed = os.listdir(apps_setting_path)
+        changed = [a for a in installed if a not in index['apps']
+                   or keys.get(a) != _get_app_settings_key(a)]
+        stale = [a for a in index['apps'] if a not in installed]
+        if changed or stale:
+            for app_id in stale:
+                _set_app_location(index, app_id, None)
+            for app_id in changed:
+                _set_app_location(index, app_id, _get_app_settings(app_id))
+            _write_locations_index(index)
+        return index
+
+
+def _update_locations_index(app_id, settings):
+    """
+    Update the location of an app in the locations index - if it has
+    already been built
+
+    Keyword arguments:
+        app_id -- The app instance name
+        settings -- The app settings, or None if it has been removed
+
+    """
+    # Do not lock - nor create the lock file - if it has not been built
+    if not os.path.exists(locations_index):
+        return
+    with _lock_locations_index():
+        if not os.path.exists(locations_index):
+            return
+        index = _get_locations_index()
+        if app_id in index['apps'] and \
+                index['apps'][app_id] == _get_app_location(settings) and \
+                index['keys'].get(app_id) == _get_app_settings_key(app_id):
+            return
+        _set_app_location(index, app_id, settings)
+        _write_locations_index(index)
+
+
+def _find_app_locations(domain, path, exclude=[]):
+    """
+    Find the apps which use a web path or one of its parents
+
+    Keyword arguments:
+        domain -- The domain of the web path
+        path -- The web path
+        exclude -- App ids to ignore
+
+    Returns:
+        A tuple of the list of apps installed at this path, and the list of
+        apps installed at one of its parent paths
+
+    """
+    node = _get_locations_index()['domains'].get(domain)
+    parents = []
+    for segment in _split_app_path(path):
+        if node is None:
+            return [], parents
+        parents.extend(a for a in node['apps'] if a not in exclude)
+        node = node['sub'].get(segment)
+    if node is None:
+        return [], parents
+    return [a for a in node['apps'] if a not in exclude], parents
+
+
+def _get_app_settings(app_id):
+    """
+    Get settings of an installed app
+
+    Keyword arguments:
+        app_id -- The app id
+
+    """
+    if not _is_installed(app_id):
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('app_not_installed', app=app_id))
+    try:
+        settings = _load_app_settings(app_id)
+        if app_id == settings['id']:
+            # Serve a copy so that the cached settings are not altered
+            return _copy_app_settings(settings)
+    except (IOError, OSError, TypeError, KeyError, yaml.YAMLError):
+        logger.exception(m18n.n('app_not_correctly_installed',
+                                app=app_id))
+    return {}
+
+
+def _load_app_settings(app_id):
+    """
+    Load settings of an app through the process-wide settings cache
+
+    Settings are parsed again only if the (inode, mtime, size) of their
+    file has changed since they have been cached.
+
+    Keyword arguments:
+        app_id -- The app id
+
+    """
+    stats = _app_settings_cache_stats
+    with open(os.path.join(
+            apps_setting_path, app_id, 'settings.yml')) as f:
+        st = os.fstat(f.fileno())
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        cached = _app_settings_cache.get(app_id)
+        if cached is not None and cached[0] == key:
+            stats['hits'] += 1
+            return cached[1]
+        try:
+            settings = yaml.load(f, Loader=_yaml_loader)
+        except yaml.constructor.ConstructorError:
+            # Legacy settings may contain python tags - e.g. !!python/unicode
+            # - which are only supported by the full loader
+            f.seek(0)
+            settings = yaml.load(f, Loader=yaml.Loader)
+    stats['misses'] += 1
+    logger.debug("apps settings cache miss for '%s' (hits: %d, misses: %d)",
+                 app_id, stats['hits'], stats['misses'])
+    _app_settings_cache[app_id] = (key, settings)
+    return settings
+
+
+def _copy_app_settings(settings):
+    """
+    Return a copy of app settings which can be altered without altering
+    the given ones
+
+    Scalar values - which are immutable - are shared with the given
+    settings, only container values - e.g. redirected_urls - are copied.
+    It makes the copy about as cheap as a shallow one for most apps.
+
+    Keyword arguments:
+        settings -- Dict with app settings
+
+    """
+    copied = dict(settings)
+    for k, v in settings.iteritems():
+        if isinstance(v, (dict, list)):
+            copied[k] = copy.deepcopy(v)
+    return copied
+
+
+def _get_installed_apps_settings():
+    """
+    Get settings of all installed apps
+
+    Returns:
+        An ordered dict of settings by app id, without apps whose settings
+        can not be retrieved
+
+    """
+    apps_settings = OrderedDict()
+    for app_id in sorted(os.listdir(apps_setting_path)):
+        app_settings = _get_app_settings(app_id)
+        if app_settings:
+            apps_settings[app_id] = app_settings
+    return apps_settings
+
+
+def _get_app_allowed_users(app_settings):
+    """
+    Return the set of users allowed to access an app, or None if it is
+    accessible by everyone
+
+    Keyword arguments:
+        app_settings -- Dict with app settings
+
+    """
+    if app_settings.get('mode', 'private') == 'private' \
+            and 'allowed_users' in app_settings:
+        return set(app_settings['allowed_users'].split(','))
+    return None
+
+
+def _build_users_apps_map(apps_settings, users):
+    """
+    Build the map of allowed apps of each user
+
+    An index of the restricted apps by allowed user is built first from
+    the apps settings, so that the map of each user is made without going
+    through all apps settings again.
+
+    Keyword arguments:
+        apps_settings -- A dict of settings by app id
+        users -- List of usernames to build the map for
+
+    Returns:
+        A dict of {domain + path: label} by username
+
+    """
+    public_apps = {}
+    restricted_apps = {}
+    for app_settings in apps_settings.values():
+        if 'domain' not in app_settings:
+            continue
+        url = app_settings['domain'] + app_settings.get('path', '/')
+        allowed_users = _get_app_allowed_users(app_settings)
+        if allowed_users is None:
+            public_apps[url] = app_settings['label']
+        else:
+            for user in allowed_users:
+                restricted_apps.setdefault(user, {})[url] = \
+                    app_settings['label']
+
+    users_map = {}
+    for user in users:
+        users_map[user] = dict(public_apps)
+        users_map[user].update(restricted_apps.get(user, {}))
+    return users_map
+
+
+def _set_app_settings(app_id, settings):
+    """
+    Set settings of an app
+
+    The settings file is replaced atomically - keeping its permissions -
+    and the settings cache is updated accordingly.
+
+    Keyword arguments:
+        app_id -- The app id
+        settings -- Dict with app settings
+
+    """
+    settings_path = os.path.join(apps_setting_path, app_id, 'settings.yml')
+    tmp_path = settings_path + '.tmp'
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+        yaml.safe_dump(settings, f, default_flow_style=False)
+    try:
+        st = os.stat(settings_path)
+    except OSError:
+        pass
+    else:
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.chown(tmp_path, st.st_uid, st.st_gid)
+    os.rename(tmp_path, settings_path)
+
+    st = os.stat(settings_path)
+    _app_settings_cache[app_id] = (
+        (st.st_ino, st.st_mtime, st.st_size), _copy_app_settings(settings))
+
+    _update_locations_index(app_id, settings)
+
+
+def _format_shell_assignments(settings):
+    """
+    Format settings as shell variables assignments, one by line
+
+    Each variable is named after the setting key - with any character
+    invalid in a shell variable name replaced by an underscore - and its
+    value is quoted. Unset settings are assigned an empty string and
+    non-scalar values are serialized as JSON.
+
+    Keyword arguments:
+        settings -- A dict of settings
+
+    """
+    lines = []
+    for key, value in settings.items():
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', _encode_string(key))
+        if not name or name[0].isdigit():
+            name = '_' + name
+        if value is None:
+            value = ''
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        elif not isinstance(value, basestring):
+            value = str(value)
+        lines.append('{0}={1}'.format(name, pipes.quote(_encode_string(value))))
+    return '\n'.join(lines)
+
+
+def _get_app_status(app_id, format_date=False):
+    """
+    Get app status or create it if needed
+
+    Keyword arguments:
+        app_id -- The app id
         format_date -- Format date fields
 
     """
@@ -1106,107 +2385,283 @@ def _get_app_status(app_id, format_date=False):
         with open(app_setting_path + '/status.json', 'w+') as f:
             json.dump(status, f)
 
-    if format_date:
-        for f in ['installed_at', 'upgraded_at']:
-            v = status.get(f, None)
-            if not v:
-                status[f] = '-'
+    if format_date:
+        for f in ['installed_at', 'upgraded_at']:
+            v = status.get(f, None)
+            if not v:
+                status[f] = '-'
+            else:
+                status[f] = time.strftime(m18n.n('format_datetime_short'),
+                                          time.gmtime(v))
+    return status
+
+
+def _extract_app_from_file(path, remove=False, work_dir=None):
+    """
+    Unzip or untar application tarball in a work directory, or copy it from
+    a directory
+
+    The manifest is read first so that invalid packages are rejected before
+    being extracted, and the single top-level directory of the sources - if
+    any - is stripped while extracting.
+
+    Keyword arguments:
+        path -- Path of the tarball or directory
+        remove -- Remove the tarball after extraction
+        work_dir -- Directory where to extract the app (default: app_tmp_folder)
+
+    Returns:
+        Dict manifest
+
+    """
+    if work_dir is None:
+        work_dir = app_tmp_folder
+
+    logger.info(m18n.n('extracting'))
+
+    if os.path.exists(work_dir): shutil.rmtree(work_dir)
+
+    path = os.path.abspath(path)
+
+    try:
+        if ".zip" in path:
+            manifest = _extract_app_from_zip(path, work_dir)
+        elif ".tar" in path:
+            manifest = _extract_app_from_tar(path, work_dir)
+        elif os.path.isdir(path):
+            manifest = _copy_app_from_directory(path, work_dir)
+        else:
+            raise MoulinetteError(errno.EINVAL,
+                                  m18n.n('app_extraction_failed'))
+    except MoulinetteError:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except (zipfile.BadZipfile, tarfile.TarError, IOError, OSError):
+        logger.debug('unable to extract %s', path, exc_info=1)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise MoulinetteError(errno.EINVAL, m18n.n('app_extraction_failed'))
+    finally:
+        if remove and os.path.isfile(path):
+            os.remove(path)
+
+    manifest['lastUpdate'] = int(time.time())
+
+    logger.info(m18n.n('done'))
+
+    manifest['remote'] = {'type': 'file', 'path': path}
+    return manifest
+
+
+def _extract_app_from_zip(path, work_dir):
+    """Extract app sources from a zip archive and return the manifest"""
+    with zipfile.ZipFile(path) as archive:
+        members = _strip_archive_top_dir(
+            [(m, m.filename) for m in archive.infolist()])
+
+        manifest = _load_app_manifest(members, archive.open)
+
+        os.makedirs(work_dir)
+        symlinks = []
+        for name, member in members.items():
+            target = os.path.join(work_dir, name)
+            _check_extraction_target(work_dir, target)
+            mode = member.external_attr >> 16
+            if member.filename.endswith('/'):
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if stat.S_ISLNK(mode):
+                symlinks.append((target, archive.read(member)))
+                continue
+            with archive.open(member) as fsrc:
+                with open(target, 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst)
+            if mode & 07777:
+                os.chmod(target, mode & 07777)
+
+        # Create symbolic links once all other members have been written,
+        # so that no file is written through them
+        for target, link in symlinks:
+            _check_extraction_target(work_dir, target)
+            os.symlink(link, target)
+    return manifest
+
+
+def _extract_app_from_tar(path, work_dir):
+    """Extract app sources from a tar archive and return the manifest"""
+    with tarfile.open(path, 'r:*') as archive:
+        members = _strip_archive_top_dir(
+            [(m, m.name) for m in archive.getmembers()
+             if m.isfile() or m.isdir() or m.issym() or m.islnk()])
+
+        manifest = _load_app_manifest(members, archive.extractfile)
+
+        os.makedirs(work_dir)
+        stripped = dict((m.name, n) for n, m in members.items())
+        symlinks = []
+        for name, member in members.items():
+            if member.islnk():
+                if member.linkname not in stripped:
+                    continue
+                member.linkname = stripped[member.linkname]
+            member.name = name
+            _check_extraction_target(work_dir, os.path.join(work_dir, name))
+            if member.issym():
+                symlinks.append(member)
+                continue
+            archive.extract(member, work_dir)
+
+        # Create symbolic links once all other members have been written,
+        # so that no file is written through them
+        for member in symlinks:
+            _check_extraction_target(
+                work_dir, os.path.join(work_dir, member.name))
+            archive.extract(member, work_dir)
+    return manifest
+
+
+def _copy_app_from_directory(path, work_dir):
+    """
+    Copy app sources from a directory and return the manifest
+
+    Files are cloned - i.e. they share their data blocks until modified -
+    if the filesystem supports it, and copied otherwise.
+
+    """
+    content = os.listdir(path)
+    if len(content) == 1 and os.path.isdir(os.path.join(path, content[0])):
+        path = os.path.join(path, content[0])
+
+    manifest = _load_app_manifest(
+        {'manifest.json': os.path.join(path, 'manifest.json')}, open)
+
+    dirs_stats = []
+    for root, dirs, files in os.walk(path):
+        target_root = os.path.normpath(
+            os.path.join(work_dir, os.path.relpath(root, path)))
+        os.makedirs(target_root)
+        dirs_stats.append((root, target_root))
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            elif name in files and os.path.isfile(source):
+                _clone_file(source, target)
             else:
-                status[f] = time.strftime(m18n.n('format_datetime_short'),
-                                          time.gmtime(v))
-    return status
+                continue
+            _copy_owner(source, target)
+
+    # Set directories attributes once their content has been copied
+    for source, target in reversed(dirs_stats):
+        shutil.copystat(source, target)
+        _copy_owner(source, target)
+    return manifest
 
 
-def _extract_app_from_file(path, remove=False):
+def _strip_archive_top_dir(members):
     """
-    Unzip or untar application tarball in app_tmp_folder, or copy it from a directory
+    Return archive members by their path relative to the single top-level
+    directory of the archive - if any
 
     Keyword arguments:
-        path -- Path of the tarball or directory
-        remove -- Remove the tarball after extraction
-
-    Returns:
-        Dict manifest
+        members -- List of (member, path in the archive) tuples
 
     """
-    global app_tmp_folder
+    paths = []
+    for member, name in members:
+        parts = [p for p in name.split('/') if p and p != '.']
+        if name.startswith('/') or '..' in parts:
+            raise MoulinetteError(errno.EINVAL,
+                                  m18n.n('app_extraction_failed'))
+        if parts:
+            paths.append((member, parts))
+
+    top_dirs = set(parts[0] for _, parts in paths)
+    strip = len(top_dirs) == 1 and any(len(parts) > 1 for _, parts in paths)
+
+    result = OrderedDict()
+    for member, parts in paths:
+        if strip:
+            parts = parts[1:]
+        if parts:
+            result['/'.join(parts)] = member
+    return result
 
-    logger.info(m18n.n('extracting'))
 
-    if os.path.exists(app_tmp_folder): shutil.rmtree(app_tmp_folder)
-    os.makedirs(app_tmp_folder)
+def _check_extraction_target(work_dir, target):
+    """
+    Reject an archive member whose parent directory resolves - following
+    symbolic links - outside of the work directory
+
+    """
+    root = os.path.realpath(work_dir)
+    parent = os.path.realpath(os.path.dirname(target))
+    if parent != root and not parent.startswith(root + os.sep):
+        raise MoulinetteError(errno.EINVAL, m18n.n('app_extraction_failed'))
 
-    path = os.path.abspath(path)
 
-    if ".zip" in path:
-        extract_result = os.system('unzip %s -d %s > /dev/null 2>&1' % (path, app_tmp_folder))
-        if remove: os.remove(path)
-    elif ".tar" in path:
-        extract_result = os.system('tar -xf %s -C %s > /dev/null 2>&1' % (path, app_tmp_folder))
-        if remove: os.remove(path)
-    elif os.path.isdir(path):
-        shutil.rmtree(app_tmp_folder)
-        if path[len(path)-1:] != '/':
-            path = path + '/'
-        extract_result = os.system('cp -a "%s" %s' % (path, app_tmp_folder))
-    else:
-        extract_result = 1
+def _load_app_manifest(members, open_member):
+    """
+    Load the manifest of app sources
 
-    if extract_result != 0:
-        raise MoulinetteError(errno.EINVAL, m18n.n('app_extraction_failed'))
+    Keyword arguments:
+        members -- Dict of the sources members by their relative path
+        open_member -- Function which returns a file object from a member
 
+    """
+    if 'manifest.json' not in members:
+        raise MoulinetteError(errno.EIO, m18n.n('app_install_files_invalid'))
     try:
-        if len(os.listdir(app_tmp_folder)) == 1:
-            for folder in os.listdir(app_tmp_folder):
-                app_tmp_folder = app_tmp_folder +'/'+ folder
-        with open(app_tmp_folder + '/manifest.json') as json_manifest:
-            manifest = json.loads(str(json_manifest.read()))
-            manifest['lastUpdate'] = int(time.time())
+        with closing(open_member(members['manifest.json'])) as f:
+            return json.loads(str(f.read()))
     except IOError:
         raise MoulinetteError(errno.EIO, m18n.n('app_install_files_invalid'))
+    except ValueError:
+        raise MoulinetteError(errno.EINVAL, m18n.n('app_manifest_invalid'))
 
-    logger.info(m18n.n('done'))
-
-    manifest['remote'] = {'type': 'file', 'path': path}
-    return manifest
 
+def _clone_file(source, target):
+    """
+    Copy a file by cloning its data blocks if possible, and its permission
+    bits and times
 
-def _get_git_last_commit_hash(repository, reference='HEAD'):
     """
-    Attempt to retrieve the last commit hash of a git repository
+    with open(source, 'rb') as fsrc:
+        with open(target, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except IOError:
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(source, target)
 
-    Keyword arguments:
-        repository -- The URL or path of the repository
 
-    """
+def _copy_owner(source, target):
+    """Copy the owner and group of a file - without following symlinks"""
+    st = os.lstat(source)
     try:
-        commit = subprocess.check_output(
-            "git ls-remote --exit-code {0} {1} | awk '{{print $1}}'".format(
-                repository, reference),
-            shell=True)
-    except subprocess.CalledProcessError:
-        logger.exception("unable to get last commit from %s", repository)
-        raise ValueError("Unable to get last commit with git")
-    else:
-        return commit.strip()
+        os.lchown(target, st.st_uid, st.st_gid)
+    except OSError:
+        pass
 
 
-def _fetch_app_from_git(app):
+def _fetch_app_from_git(app, work_dir=None):
     """
-    Unzip or untar application tarball in app_tmp_folder
+    Check out application sources from its git repository in a work
+    directory, through the local git cache
 
     Keyword arguments:
         app -- App_id or git repo URL
+        work_dir -- Directory where to fetch the app (default: app_tmp_folder)
 
     Returns:
         Dict manifest
 
     """
-    app_tmp_archive = '{0}.zip'.format(app_tmp_folder)
-    if os.path.exists(app_tmp_folder):
-        shutil.rmtree(app_tmp_folder)
-    if os.path.exists(app_tmp_archive):
-        os.remove(app_tmp_archive)
+    if work_dir is None:
+        work_dir = app_tmp_folder
 
     logger.info(m18n.n('downloading'))
 
@@ -1221,55 +2676,17 @@ def _fetch_app_from_git(app):
                 owner=github_repo.group('owner'),
                 repo=github_repo.group('repo'),
             )
-            tarball_url = "{url}/archive/{tree}.zip".format(
-                url=url, tree=branch
-            )
-            try:
-                subprocess.check_call([
-                    'wget', '-qO', app_tmp_archive, tarball_url])
-            except subprocess.CalledProcessError:
-                logger.exception('unable to download %s', tarball_url)
-                raise MoulinetteError(errno.EIO,
-                                      m18n.n('app_sources_fetch_failed'))
-            else:
-                manifest = _extract_app_from_file(
-                    app_tmp_archive, remove=True)
         else:
             tree_index = url.rfind('/tree/')
             if tree_index > 0:
                 url = url[:tree_index]
                 branch = app[tree_index+6:]
-            try:
-                subprocess.check_call([
-                    'git', 'clone', '--depth=1', url, app_tmp_folder])
-                subprocess.check_call([
-                        'git', 'reset', '--hard', branch
-                    ], cwd=app_tmp_folder)
-                with open(app_tmp_folder + '/manifest.json') as f:
-                    manifest = json.loads(str(f.read()))
-            except subprocess.CalledProcessError:
-                raise MoulinetteError(errno.EIO,
-                                      m18n.n('app_sources_fetch_failed'))
-            except IOError:
-                raise MoulinetteError(errno.EIO,
-                                      m18n.n('app_manifest_invalid'))
-            else:
-                logger.info(m18n.n('done'))
-
-        # Store remote repository info into the returned manifest
-        manifest['remote'] = {'type': 'git', 'url': url, 'branch': branch}
-        try:
-            revision = _get_git_last_commit_hash(url, branch)
-        except: pass
-        else:
-            manifest['remote']['revision'] = revision
+        revision = _checkout_app_from_git(url, branch, work_dir)
     else:
-        app_dict = app_list(raw=True)
+        app_dict = app_list(filter=app, raw=True)
 
         if app in app_dict:
             app_info = app_dict[app]
-            app_info['manifest']['lastUpdate'] = app_info['lastUpdate']
-            manifest = app_info['manifest']
         else:
             raise MoulinetteError(errno.EINVAL, m18n.n('app_unknown'))
 
@@ -1277,50 +2694,493 @@ def _fetch_app_from_git(app):
             raise MoulinetteError(errno.EINVAL,
                                   m18n.n('app_unsupported_remote_type'))
         url = app_info['git']['url']
+        branch = app_info['git']['branch']
+        revision = str(app_info['git']['revision'])
+        if revision == 'HEAD':
+            # Use the head of the catalog branch - not the default one
+            revision = 'refs/heads/%s' % branch
+        revision = _checkout_app_from_git(url, revision, work_dir)
 
-        if 'github.com' in url:
-            tarball_url = "{url}/archive/{tree}.zip".format(
-                url=url, tree=app_info['git']['revision']
-            )
-            try:
-                subprocess.check_call([
-                    'wget', '-qO', app_tmp_archive, tarball_url])
-            except subprocess.CalledProcessError:
-                logger.exception('unable to download %s', tarball_url)
-                raise MoulinetteError(errno.EIO,
-                                      m18n.n('app_sources_fetch_failed'))
-            else:
-                manifest = _extract_app_from_file(
-                    app_tmp_archive, remove=True)
-        else:
-            try:
+    try:
+        with open(work_dir + '/manifest.json') as f:
+            manifest = json.loads(str(f.read()))
+    except (IOError, ValueError):
+        raise MoulinetteError(errno.EIO, m18n.n('app_manifest_invalid'))
+
+    logger.info(m18n.n('done'))
+
+    # Store remote repository info into the returned manifest
+    manifest['remote'] = {
+        'type': 'git',
+        'url': url,
+        'branch': branch,
+        'revision': revision,
+    }
+    return manifest
+
+
+def _checkout_app_from_git(url, revision, work_dir):
+    """
+    Extract a revision of a git repository to a work directory
+
+    The sources archive of the revision is taken from the archive store if
+    it is already there, or exported from the mirror of the repository in
+    the local git cache and added to the store. Least recently used
+    archives are then pruned to keep the store under
+    archive_store_max_size.
+
+    Keyword arguments:
+        url -- URL of the git repository
+        revision -- Branch, tag or commit to extract
+        work_dir -- Directory where to extract files
+
+    Returns:
+        The hash of the extracted commit
+
+    """
+    archive = None
+    if re_git_commit.match(revision):
+        commit = revision
+        archive = _get_archive_from_store(url, commit)
+    if archive is None:
+        commit, archive = _export_git_archive(url, revision)
+
+    # The archive is pinned until it has been extracted
+    try:
+        _extract_app_from_file(archive, work_dir=work_dir)
+        _prune_archive_store(archive_store_max_size, keep=[archive])
+    finally:
+        _unpin_store_archive(archive)
+    return commit
+
+
+def _export_git_archive(url, revision):
+    """
+    Export the sources archive of a revision of a git repository from its
+    mirror in the local git cache to the archive store
+
+    The mirror is created or fetched as needed - it is not fetched if it
+    already contains the given commit - and least recently used mirrors
+    are then pruned to keep the cache under git_cache_max_size.
+
+    Keyword arguments:
+        url -- URL of the git repository
+        revision -- Branch, tag or commit to export
+
+    Returns:
+        A tuple of the hash of the exported commit and the archive path,
+        which is pinned - see _get_archive_from_store
+
+    """
+    mirror = _get_git_mirror_path(url)
+    if not os.path.isdir(git_cache_path):
+        os.makedirs(git_cache_path)
+
+    with _lock_git_mirror(mirror):
+        try:
+            if not os.path.isdir(mirror):
                 subprocess.check_call([
-                    'git', 'clone', app_info['git']['url'],
-                    '-b', app_info['git']['branch'], app_tmp_folder])
+                    'git', 'clone', '--quiet', '--mirror', url, mirror])
+            elif not re_git_commit.match(revision) or \
+                    _resolve_git_revision(mirror, revision) is None:
                 subprocess.check_call([
-                        'git', 'reset', '--hard',
-                        str(app_info['git']['revision'])
-                    ], cwd=app_tmp_folder)
-                with open(app_tmp_folder + '/manifest.json') as f:
-                    manifest = json.loads(str(f.read()))
-            except subprocess.CalledProcessError:
+                    'git', 'fetch', '--quiet', '--prune', 'origin'
+                    ], cwd=mirror)
+        except (subprocess.CalledProcessError, OSError):
+            logger.debug('unable to fetch %s', url, exc_info=1)
+            raise MoulinetteError(errno.EIO,
+                                  m18n.n('app_sources_fetch_failed'))
+
+        commit = _resolve_git_revision(mirror, revision)
+        if commit is None:
+            logger.debug("unknown revision '%s' in %s", revision, url)
+            raise MoulinetteError(errno.EIO,
+                                  m18n.n('app_sources_fetch_failed'))
+
+        # Export files of the commit if they are not already in the store
+        archive = _get_archive_from_store(url, commit)
+        if archive is None:
+            p = subprocess.Popen([
+                'git', 'archive', '--format=tar', '--prefix=%s/' % commit,
+                commit], cwd=mirror, stdout=subprocess.PIPE)
+
+            def _check_export():
+                p.stdout.close()
+                return p.wait() == 0
+
+            try:
+                archive = _add_archive_to_store(
+                    url, commit, p.stdout, check=_check_export)
+            finally:
+                if p.poll() is None:
+                    p.stdout.close()
+                    p.wait()
+            if archive is None:
+                logger.debug('unable to export %s from %s', commit, url)
                 raise MoulinetteError(errno.EIO,
                                       m18n.n('app_sources_fetch_failed'))
-            except IOError:
-                raise MoulinetteError(errno.EIO,
-                                      m18n.n('app_manifest_invalid'))
-            else:
-                logger.info(m18n.n('done'))
 
-        # Store remote repository info into the returned manifest
-        manifest['remote'] = {
-            'type': 'git',
-            'url': url,
-            'branch': app_info['git']['branch'],
-            'revision': app_info['git']['revision'],
-        }
+        # Mark the mirror as recently used
+        os.utime(mirror, None)
+
+    _prune_git_cache(git_cache_max_size, keep=[mirror])
+    return commit, archive
+
+
+def _get_git_mirror_path(url):
+    """Return the path of the mirror of a git repository in the cache"""
+    return os.path.join(git_cache_path,
+                        hashlib.sha1(url.rstrip('/')).hexdigest() + '.git')
+
+
+@contextmanager
+def _lock_git_mirror(mirror):
+    """Hold an exclusive lock on a mirror of the git cache"""
+    with open(mirror + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _resolve_git_revision(mirror, revision):
+    """Return the commit hash of a revision from the mirror refs or None"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output([
+                'git', 'rev-parse', '--quiet', '--verify',
+                '%s^{commit}' % revision,
+                ], cwd=mirror, stderr=devnull).strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def _get_archive_store_ref(url, revision):
+    """Return the path of the reference to the archive of a revision"""
+    return os.path.join(archive_store_path, 'refs', hashlib.sha1(
+        '%s\0%s' % (url.rstrip('/'), revision)).hexdigest())
+
+
+def _get_archive_from_store(url, revision):
+    """
+    Return the path of the sources archive of a git revision from the
+    archive store, or None if it is not there or is corrupted
+
+    The returned archive is pinned so that it is not pruned while it is
+    used: it must be released with _unpin_store_archive.
+
+    """
+    ref = _get_archive_store_ref(url, revision)
+    try:
+        with open(ref) as f:
+            digest = f.read().strip()
+    except IOError:
+        return None
+
+    archive = os.path.join(archive_store_path, digest + '.tar')
+    _pin_store_archive(archive)
+    sha256 = hashlib.sha256()
+    try:
+        with open(archive, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha256.update(chunk)
+    except IOError:
+        logger.debug("archive %s of %s@%s is missing", archive, url, revision)
+        _unpin_store_archive(archive)
+        try:
+            os.remove(ref)
+        except OSError:
+            pass
+        return None
+    if sha256.hexdigest() != digest:
+        logger.warning("archive %s of %s@%s is corrupted, removing it",
+                       archive, url, revision)
+        _unpin_store_archive(archive)
+        os.remove(archive)
+        os.remove(ref)
+        return None
+
+    # Mark the archive as recently used
+    os.utime(archive, None)
+    return archive
+
+
+def _add_archive_to_store(url, revision, fileobj, check=None):
+    """
+    Store the sources archive of a git revision read from a file object
+
+    The archive is stored under its SHA-256 hash - so that identical ones
+    are stored only once - and referenced by its URL and revision.
+
+    Keyword arguments:
+        url -- URL of the git repository
+        revision -- The git revision
+        fileobj -- File object to read the archive from
+        check -- Function called once the archive has been read, which
+            returns False if it is incomplete - e.g. its producer failed
+
+    Returns:
+        The path of the stored archive - which is pinned, see
+        _get_archive_from_store - or None if the check failed
+
+    """
+    refs_dir = os.path.join(archive_store_path, 'refs')
+    if not os.path.isdir(refs_dir):
+        os.makedirs(refs_dir)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=archive_store_path)
+    sha256 = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: fileobj.read(65536), ''):
+                sha256.update(chunk)
+                f.write(chunk)
+        if check is not None and not check():
+            os.remove(tmp_path)
+            return None
+        digest = sha256.hexdigest()
+        archive = os.path.join(archive_store_path, digest + '.tar')
+        _pin_store_archive(archive)
+        os.rename(tmp_path, archive)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    ref = _get_archive_store_ref(url, revision)
+    with open(ref + '.tmp', 'w') as f:
+        f.write(digest)
+    os.rename(ref + '.tmp', ref)
+    return archive
+
+
+def _pin_store_archive(archive):
+    """Prevent an archive of the store from being pruned while it is used"""
+    with _archive_store_lock:
+        _archive_store_pins[archive] = _archive_store_pins.get(archive, 0) + 1
+
+
+def _unpin_store_archive(archive):
+    """Release an archive pinned by _pin_store_archive"""
+    with _archive_store_lock:
+        count = _archive_store_pins.pop(archive, 0) - 1
+        if count > 0:
+            _archive_store_pins[archive] = count
+
+
+def _get_archive_store_objects():
+    """
+    Return the path, the size in bytes and the last use time of each
+    archive of the store, from the least recently used
+
+    """
+    archives = []
+    for archive in glob.iglob(os.path.join(archive_store_path, '*.tar')):
+        st = os.stat(archive)
+        archives.append({
+            'path': archive,
+            'size': st.st_size,
+            'last_used': int(st.st_mtime),
+        })
+    return sorted(archives, key=lambda a: a['last_used'])
+
+
+def _prune_archive_store(max_size, keep=[]):
+    """
+    Remove least recently used archives of the store until its size is
+    under max_size, and the references to removed archives
+
+    Archives pinned by threads of this process are not removed either.
+
+    Keyword arguments:
+        max_size -- Maximum size of the store in bytes
+        keep -- Paths of archives to not remove
+
+    Returns:
+        The list of removed archives
+
+    """
+    archives = _get_archive_store_objects()
+    size = sum(a['size'] for a in archives)
+    removed = []
+    with _archive_store_lock:
+        for archive in archives:
+            if size <= max_size:
+                break
+            if archive['path'] in keep or \
+                    archive['path'] in _archive_store_pins:
+                continue
+            try:
+                os.remove(archive['path'])
+            except OSError:
+                continue
+            size -= archive['size']
+            removed.append(archive['path'])
+            logger.debug("archive %s removed from the store", archive['path'])
+
+    if removed:
+        for ref in glob.iglob(os.path.join(archive_store_path, 'refs', '*')):
+            try:
+                with open(ref) as f:
+                    archive = os.path.join(archive_store_path,
+                                           f.read().strip() + '.tar')
+                if archive in removed:
+                    os.remove(ref)
+            except (IOError, OSError):
+                pass
+    return removed
+
+
+def _get_git_cache_mirrors():
+    """
+    Return the path, the size in bytes and the last use time of each mirror
+    of the git cache, from the least recently used
+
+    """
+    mirrors = []
+    for mirror in glob.iglob(os.path.join(git_cache_path, '*.git')):
+        size = 0
+        for root, dirs, files in os.walk(mirror):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+        mirrors.append({
+            'path': mirror,
+            'size': size,
+            'last_used': int(os.stat(mirror).st_mtime),
+        })
+    return sorted(mirrors, key=lambda m: m['last_used'])
+
+
+def _prune_git_cache(max_size, keep=[]):
+    """
+    Remove least recently used mirrors of the git cache until its size is
+    under max_size
+
+    Keyword arguments:
+        max_size -- Maximum size of the cache in bytes
+        keep -- Paths of mirrors to not remove
+
+    Returns:
+        The list of removed mirrors
+
+    """
+    mirrors = _get_git_cache_mirrors()
+    size = sum(m['size'] for m in mirrors)
+    removed = []
+    for mirror in mirrors:
+        if size <= max_size:
+            break
+        if mirror['path'] in keep:
+            continue
+        with _lock_git_mirror(mirror['path']):
+            shutil.rmtree(mirror['path'], ignore_errors=True)
+        size -= mirror['size']
+        removed.append(mirror['path'])
+        logger.debug("git mirror %s removed from the cache", mirror['path'])
+    return removed
+
+
+def _run_app_upgrade_script(app_instance_name, work_dir, args_list, env_dict,
+                            status):
+    """
+    Execute the upgrade script of an app from its work directory and replace
+    its hooks, scripts and manifest on success
+
+    Returns:
+        True if the app has been upgraded
+
+    """
+    from yunohost.hook import hook_add, hook_exec, hook_remove
+
+    if hook_exec(work_dir +'/scripts/upgrade', args=args_list, env=env_dict) != 0:
+        logger.error(m18n.n('app_upgrade_failed', app=app_instance_name))
+        return False
+
+    # Clean hooks and add new ones
+    hook_remove(app_instance_name)
+    if 'hooks' in os.listdir(work_dir):
+        for hook in os.listdir(work_dir +'/hooks'):
+            hook_add(app_instance_name, work_dir +'/hooks/'+ hook)
+
+    app_setting_path = apps_setting_path +'/'+ app_instance_name
+
+    now = int(time.time())
+    # TODO: Move install_time away from app_setting
+    app_setting(app_instance_name, 'update_time', now)
+    status['upgraded_at'] = now
+    _invalidate_upgrades_index(app_instance_name)
+
+    # Store app status
+    with open(app_setting_path + '/status.json', 'w+') as f:
+        json.dump(status, f)
+
+    # Replace scripts and manifest
+    os.system('rm -rf "%s/scripts" "%s/manifest.json"' % (app_setting_path, app_setting_path))
+    os.system('mv "%s/manifest.json" "%s/scripts" %s' % (work_dir, work_dir, app_setting_path))
+
+    # So much win
+    logger.success(m18n.n('app_upgraded', app=app_instance_name))
+    return True
 
-    return manifest
+
+def _run_scheduled_jobs(jobs, workers=1):
+    """
+    Run jobs in parallel threads, without running at the same time the
+    ones which share a key - they are started in the given order
+
+    Keyword arguments:
+        jobs -- List of (keys, function, args) tuples
+        workers -- Maximum number of jobs to run at the same time
+
+    Returns:
+        The list of the jobs results, or of the exceptions they raised
+
+    """
+    results = [None] * len(jobs)
+
+    def _run(i):
+        _, func, args = jobs[i]
+        try:
+            results[i] = func(*args)
+        except Exception as e:
+            logger.debug('job %r failed', func, exc_info=1)
+            results[i] = e
+
+    if workers <= 1:
+        for i in range(len(jobs)):
+            _run(i)
+        return results
+
+    pending = range(len(jobs))
+    running = {}
+    cond = threading.Condition()
+
+    def _run_and_notify(i):
+        try:
+            _run(i)
+        finally:
+            with cond:
+                del running[i]
+                cond.notify()
+
+    with cond:
+        while pending or running:
+            busy = set()
+            for keys in running.values():
+                busy |= keys
+            for i in list(pending):
+                if len(running) >= workers:
+                    break
+                keys = jobs[i][0]
+                if not keys & busy:
+                    pending.remove(i)
+                    running[i] = keys
+                    threading.Thread(target=_run_and_notify, args=(i,)).start()
+                # Following jobs which share a key must wait for this one
+                busy |= keys
+            if running:
+                cond.wait()
+    return results
 
 
 def _installed_instance_number(app, last=False):
@@ -1335,32 +3195,83 @@ def _installed_instance_number(app, last=False):
         Number of last installed instance | List or instances
 
     """
+    numbers = _get_instances_registry().get(app, [])
     if last:
-        number = 0
-        try:
-            installed_apps = os.listdir(apps_setting_path)
-        except OSError:
-            os.makedirs(apps_setting_path)
-            return 0
+        return max(numbers) if numbers else 0
+    return sorted(numbers)
 
-        for installed_app in installed_apps:
-            if number == 0 and app == installed_app:
-                number = 1
-            elif '__' in installed_app:
-                if app == installed_app[:installed_app.index('__')]:
-                    if int(installed_app[installed_app.index('__') + 2:]) > number:
-                        number = int(installed_app[installed_app.index('__') + 2:])
 
-        return number
+def _scan_app_instances():
+    """Return the instance numbers of installed apps by app id from disk"""
+    instances = {}
+    try:
+        installed_apps = os.listdir(apps_setting_path)
+    except OSError:
+        os.makedirs(apps_setting_path)
+        return instances
+    for app_instance_name in installed_apps:
+        app_id, number = _parse_app_instance_name(app_instance_name)
+        instances.setdefault(app_id, []).append(number)
+    return instances
 
-    else:
-        instance_number_list = []
-        instances_dict = app_map(app=app, raw=True)
-        for key, domain in instances_dict.items():
-            for key, path in domain.items():
-                instance_number_list.append(path['instance'])
 
-        return sorted(instance_number_list)
+def _get_instances_registry():
+    """
+    Return the registry of installed apps instance numbers by app id - it
+    is built from disk if it does not exist yet
+
+    """
+    try:
+        with open(instances_registry) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        pass
+    with _instances_registry_transaction() as registry:
+        return registry
+
+
+@contextmanager
+def _instances_registry_transaction():
+    """
+    Hold an exclusive lock on the apps instances registry and yield it to
+    be modified, it is then written atomically if no exception is raised
+
+    """
+    with open(instances_registry + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(instances_registry) as f:
+                    registry = json.load(f)
+            except (IOError, ValueError):
+                logger.debug("building the apps instances registry")
+                registry = _scan_app_instances()
+            yield registry
+            with open(instances_registry + '.tmp', 'w') as f:
+                json.dump(registry, f)
+            os.rename(instances_registry + '.tmp', instances_registry)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _register_app_instance(app_instance_name):
+    """Add an installed app instance to the instances registry"""
+    app_id, number = _parse_app_instance_name(app_instance_name)
+    with _instances_registry_transaction() as registry:
+        numbers = registry.setdefault(app_id, [])
+        if number not in numbers:
+            numbers.append(number)
+
+
+def _unregister_app_instance(app_instance_name):
+    """Remove a removed app instance from the instances registry"""
+    app_id, number = _parse_app_instance_name(app_instance_name)
+    with _instances_registry_transaction() as registry:
+        numbers = registry.get(app_id, [])
+        if number in numbers:
+            numbers.remove(number)
+        if not numbers:
+            registry.pop(app_id, None)
 
 
 def _is_installed(app):
@@ -1410,9 +3321,9 @@ def _encode_string(value):
     return value
 
 
-def _check_manifest_requirements(manifest):
-    """Check if required packages are met from the manifest"""
-    requirements = manifest.get('requirements', dict())
+def _get_manifest_requirements(manifest):
+    """Get required packages version specifiers from the manifest"""
+    requirements = dict(manifest.get('requirements', dict()))
 
     # FIXME: Deprecate min_version key
     if 'min_version' in manifest:
@@ -1430,7 +3341,19 @@ def _check_manifest_requirements(manifest):
             raise MoulinetteError(errno.EINVAL, '{0}{1}'.format(
                 m18n.g('colon', m18n.n('app_incompatible')),
                 m18n.n('app_package_need_update')))
-    elif not requirements:
+    return requirements
+
+def _check_manifest_requirements(manifest):
+    """Check if required packages are met from the manifest"""
+    try:
+        requirements = _get_manifest_requirements(manifest)
+        specifiers = dict((pkgname, packages.SpecifierSet(spec))
+                          for pkgname, spec in requirements.items())
+    except packages.InvalidSpecifier as e:
+        raise MoulinetteError(errno.EINVAL,
+                              m18n.n('app_requirements_failed',
+                                     error=str(e)))
+    if not requirements:
         return
 
     logger.info(m18n.n('app_requirements_checking'))
@@ -1447,12 +3370,37 @@ def _check_manifest_requirements(manifest):
     # Iterate over requirements
     for pkgname, spec in requirements.items():
         version = versions[pkgname]
-        if version not in packages.SpecifierSet(spec):
+        if version not in specifiers[pkgname]:
             raise MoulinetteError(
                 errno.EINVAL, m18n.n('app_requirements_unmeet',
                                      pkgname=pkgname, version=version,
                                      spec=spec))
 
+def _check_apps_requirements(manifests):
+    """Check if required packages are met for several apps at once
+
+    Return a dict with the app id of each manifest of the `manifests` dict
+    and whether its requirements are met on this host.
+
+    """
+    requirements = {}
+    installable = {}
+    for app_id, manifest in manifests.items():
+        try:
+            app_requirements = _get_manifest_requirements(manifest)
+            # Validate version specifiers
+            for spec in app_requirements.values():
+                packages.SpecifierSet(spec)
+        except (MoulinetteError, ValueError, TypeError):
+            logger.debug("invalid requirements for app '%s'", app_id,
+                         exc_info=1)
+            installable[app_id] = False
+        else:
+            requirements[app_id] = app_requirements
+    for app_id, unmet in packages.check_requirements(requirements).items():
+        installable[app_id] = not unmet
+    return installable
+
 def _parse_args_from_manifest(manifest, action, args={}, auth=None):
     """Parse arguments needed for an action from the manifest
 
@@ -1596,8 +3544,21 @@ def _parse_app_instance_name(app_instance_name):
     True
     >>> _parse_app_instance_name('yolo__23qdqsd56') == ('yolo__23qdqsd56', 1)
     True
+    >>> _parse_app_instance_name('my-app') == ('my-app', 1)
+    True
+    >>> _parse_app_instance_name('my-app__2') == ('my-app', 2)
+    True
+    >>> _parse_app_instance_name('foo.bak') == ('foo.bak', 1)
+    True
     """
     match = re_app_instance_name.match(app_instance_name)
+    if match is None:
+        # Other directory names - e.g. with a hyphen - are split on their
+        # last '__' as when instances were counted from disk
+        appid, sep, nb = app_instance_name.rpartition('__')
+        if sep and appid and nb.isdigit() and nb[0] != '0':
+            return (appid, int(nb))
+        return (app_instance_name, 1)
     appid = match.groupdict().get('appid')
     app_instance_nb = int(match.groupdict().get('appinstancenb')) if match.groupdict().get('appinstancenb') is not None else 1
     return (appid, app_instance_nb)
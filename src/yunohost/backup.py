@@ -40,7 +40,9 @@ from moulinette.utils import filesystem
 from moulinette.utils.log import getActionLogger
 
 from yunohost.app import (
-    app_info, app_ssowatconf, _is_installed, _parse_app_instance_name
+    app_info, app_ssowatconf, _is_installed, _parse_app_instance_name,
+    _register_app_instance, _unregister_app_instance, _update_ssowatconf,
+    _ssowatconf_batch
 )
 from yunohost.hook import (
     hook_info, hook_callback, hook_exec, custom_hook_folder
@@ -56,7 +58,7 @@ logger = getActionLogger('yunohost.backup')
 
 def backup_create(name=None, description=None, output_directory=None,
                   no_compress=False, ignore_hooks=False, hooks=[],
-                  ignore_apps=False, apps=[]):
+                  ignore_apps=False, apps=[], jobs=None):
     """
     Create a backup local archive
 
@@ -69,6 +71,8 @@ def backup_create(name=None, description=None, output_directory=None,
         ignore_hooks -- Do not execute backup hooks
         apps -- List of application names to backup
         ignore_apps -- Do not backup apps
+        jobs -- Number of backup hooks of a same priority to execute in
+            parallel
 
     """
     # TODO: Add a 'clean' argument to clean output directory
@@ -155,7 +159,8 @@ def backup_create(name=None, description=None, output_directory=None,
 
         if not hooks or hooks_filtered:
             logger.info(m18n.n('backup_running_hooks'))
-            ret = hook_callback('backup', hooks_filtered, args=[tmp_dir])
+            ret = hook_callback('backup', hooks_filtered, args=[tmp_dir],
+                                jobs=jobs)
             if ret['succeed']:
                 info['hooks'] = ret['succeed']
 
@@ -295,7 +300,7 @@ def backup_create(name=None, description=None, output_directory=None,
 
 
 def backup_restore(auth, name, hooks=[], ignore_hooks=False,
-                   apps=[], ignore_apps=False, force=False):
+                   apps=[], ignore_apps=False, force=False, jobs=None):
     """
     Restore from a local backup archive
 
@@ -306,6 +311,8 @@ def backup_restore(auth, name, hooks=[], ignore_hooks=False,
         apps -- List of application names to restore
         ignore_apps -- Do not restore apps
         force -- Force restauration on an already installed system
+        jobs -- Number of restoration hooks of a same priority to execute
+            in parallel
 
     """
     # Validate what to restore
@@ -435,7 +442,8 @@ def backup_restore(auth, name, hooks=[], ignore_hooks=False,
 
         if hooks_filtered:
             logger.info(m18n.n('restore_running_hooks'))
-            ret = hook_callback('restore', hooks_filtered, args=[tmp_dir])
+            ret = hook_callback('restore', hooks_filtered, args=[tmp_dir],
+                                jobs=jobs)
             result['hooks'] = ret['succeed']
 
     # Add apps restore hook
@@ -452,59 +460,66 @@ def backup_restore(auth, name, hooks=[], ignore_hooks=False,
         else:
             apps_filtered = apps_list
 
-        for app_instance_name in apps_filtered:
-            tmp_app_dir = '{:s}/apps/{:s}'.format(tmp_dir, app_instance_name)
-            tmp_app_bkp_dir = tmp_app_dir + '/backup'
-
-            # Check if the app is not already installed
-            if _is_installed(app_instance_name):
-                logger.error(m18n.n('restore_already_installed_app',
-                        app=app_instance_name))
-                continue
+        # Update SSOwat configuration once all apps have been restored
+        with _ssowatconf_batch(auth):
+            for app_instance_name in apps_filtered:
+                tmp_app_dir = '{:s}/apps/{:s}'.format(tmp_dir, app_instance_name)
+                tmp_app_bkp_dir = tmp_app_dir + '/backup'
 
-            # Check if the app has a restore script
-            app_script = tmp_app_dir + '/settings/scripts/restore'
-            if not os.path.isfile(app_script):
-                logger.warning(m18n.n('unrestore_app', app=app_instance_name))
-                continue
-
-            tmp_script = '/tmp/restore_' + app_instance_name
-            app_setting_path = '/etc/yunohost/apps/' + app_instance_name
-            logger.info(m18n.n('restore_running_app_script', app=app_instance_name))
-            try:
-                # Copy app settings and set permissions
-                shutil.copytree(tmp_app_dir + '/settings', app_setting_path)
-                filesystem.chmod(app_setting_path, 0555, 0444, True)
-                filesystem.chmod(app_setting_path + '/settings.yml', 0400)
+                # Check if the app is not already installed
+                if _is_installed(app_instance_name):
+                    logger.error(m18n.n('restore_already_installed_app',
+                            app=app_instance_name))
+                    continue
 
-                # Execute app restore script
-                subprocess.call(['install', '-Dm555', app_script, tmp_script])
+                # Check if the app has a restore script
+                app_script = tmp_app_dir + '/settings/scripts/restore'
+                if not os.path.isfile(app_script):
+                    logger.warning(m18n.n('unrestore_app', app=app_instance_name))
+                    continue
 
-                # Prepare env. var. to pass to script
-                env_dict = {}
-                app_id, app_instance_nb = _parse_app_instance_name(app_instance_name)
-                env_dict["YNH_APP_ID"] = app_id
-                env_dict["YNH_APP_INSTANCE_NAME"] = app_instance_name
-                env_dict["YNH_APP_INSTANCE_NUMBER"] = str(app_instance_nb)
-                env_dict["YNH_APP_BACKUP_DIR"] = tmp_app_bkp_dir
+                tmp_script = '/tmp/restore_' + app_instance_name
+                app_setting_path = '/etc/yunohost/apps/' + app_instance_name
+                logger.info(m18n.n('restore_running_app_script', app=app_instance_name))
+                try:
+                    # Copy app settings and set permissions
+                    shutil.copytree(tmp_app_dir + '/settings', app_setting_path)
+                    _register_app_instance(app_instance_name)
+                    filesystem.chmod(app_setting_path, 0555, 0444, True)
+                    filesystem.chmod(app_setting_path + '/settings.yml', 0400)
+
+                    # Execute app restore script
+                    subprocess.call(['install', '-Dm555', app_script, tmp_script])
+
+                    # Prepare env. var. to pass to script
+                    env_dict = {}
+                    app_id, app_instance_nb = _parse_app_instance_name(app_instance_name)
+                    env_dict["YNH_APP_ID"] = app_id
+                    env_dict["YNH_APP_INSTANCE_NAME"] = app_instance_name
+                    env_dict["YNH_APP_INSTANCE_NUMBER"] = str(app_instance_nb)
+                    env_dict["YNH_APP_BACKUP_DIR"] = tmp_app_bkp_dir
+
+                    hook_exec(tmp_script, args=[tmp_app_bkp_dir, app_instance_name],
+                              raise_on_error=True, chdir=tmp_app_bkp_dir, env=env_dict)
+                except:
+                    logger.exception(m18n.n('restore_app_failed', app=app_instance_name))
+                    # Cleaning app directory
+                    shutil.rmtree(app_setting_path, ignore_errors=True)
+                    _unregister_app_instance(app_instance_name)
+                else:
+                    result['apps'].append(app_instance_name)
+                    _update_ssowatconf(auth)
+                finally:
+                    filesystem.rm(tmp_script, force=True)
 
-                hook_exec(tmp_script, args=[tmp_app_bkp_dir, app_instance_name],
-                          raise_on_error=True, chdir=tmp_app_bkp_dir, env=env_dict)
-            except:
-                logger.exception(m18n.n('restore_app_failed', app=app_instance_name))
-                # Cleaning app directory
-                shutil.rmtree(app_setting_path, ignore_errors=True)
-            else:
-                result['apps'].append(app_instance_name)
-            finally:
-                filesystem.rm(tmp_script, force=True)
+            if result['apps'] and result['hooks']:
+                # The system configuration may have been restored too
+                app_ssowatconf(auth)
 
     # Check if something has been restored
     if not result['hooks'] and not result['apps']:
         _clean_tmp_dir(1)
         raise MoulinetteError(errno.EINVAL, m18n.n('restore_nothings_done'))
-    if result['apps']:
-        app_ssowatconf(auth)
 
     _clean_tmp_dir()
     logger.success(m18n.n('restore_complete'))
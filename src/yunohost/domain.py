@@ -29,7 +29,6 @@ import datetime
 import re
 import shutil
 import json
-import yaml
 import errno
 import requests
 from urllib import urlopen
@@ -183,21 +182,16 @@ def domain_remove(auth, domain, force=False):
 
     """
     from yunohost.hook import hook_callback
+    from yunohost.app import _get_installed_apps_settings
 
     if not force and domain not in domain_list(auth)['domains']:
         raise MoulinetteError(errno.EINVAL, m18n.n('domain_unknown'))
 
     # Check if apps are installed on the domain
-    for app in os.listdir('/etc/yunohost/apps/'):
-        with open('/etc/yunohost/apps/' + app +'/settings.yml') as f:
-            try:
-                app_domain = yaml.load(f)['domain']
-            except:
-                continue
-            else:
-                if app_domain == domain:
-                    raise MoulinetteError(errno.EPERM,
-                                          m18n.n('domain_uninstall_app_first'))
+    for app_settings in _get_installed_apps_settings().values():
+        if app_settings.get('domain', None) == domain:
+            raise MoulinetteError(errno.EPERM,
+                                  m18n.n('domain_uninstall_app_first'))
 
     if auth.remove('virtualdomain=' + domain + ',ou=domains') or force:
         os.system('rm -rf /etc/yunohost/certs/%s' % domain)
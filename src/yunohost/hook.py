@@ -26,19 +26,95 @@
 import os
 import sys
 import re
+import pwd
+import grp
+import pipes
 import json
+import time
+import gzip
 import errno
+import atexit
+import functools
+import resource
+import shutil
 import subprocess
-from glob import iglob
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from moulinette.core import MoulinetteError
 from moulinette.utils import log
 
+from yunohost.utils.filesystem import set_permissions
+
 hook_folder = '/usr/share/yunohost/hooks/'
 custom_hook_folder = '/etc/yunohost/hooks.d/'
 
 logger = log.getActionLogger('yunohost.hook')
 
+# Registry of hooks by action - see _get_hooks_registry
+_hooks_registry = {}
+
+# The user which executes hooks
+hook_exec_user = 'admin'
+
+# Environment variables kept from the current environment for hooks - as
+# sudo does with its default configuration
+hook_exec_env_keep = ('TERM', 'TZ', 'LANG', 'LANGUAGE', 'LC_ALL')
+hook_exec_path = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+# The command used to switch to the hook user - see _make_exec_as_user
+hook_exec_setpriv = '/usr/bin/setpriv'
+
+# Credentials of users - see _get_user_credentials
+_users_credentials = {}
+
+# Hooks output capture: the number of lines kept to report a failure, the
+# maximum number of lines - and time in seconds - grouped in one log record
+# and the rate of lines logged per second, with the allowed burst
+hook_output_tail_size = 50
+hook_output_batch_size = 100
+hook_output_batch_delay = 0.5
+hook_output_rate = 200
+hook_output_burst = 2000
+
+# Directory where the full output of hooks is spooled by operation, and the
+# number of spool files to keep
+hook_output_spool_dir = '/var/log/yunohost/hooks'
+hook_output_spool_keep = 100
+
+# File where hooks executions statistics are appended, and its size from
+# which it is rotated
+hook_stats_path = '/var/log/yunohost/hooks.stats'
+hook_stats_max_size = 1024 * 1024
+
+# Spool file of the current operation and the number of hooks executions
+# using it - see _write_to_output_spool
+_output_spool = {}
+_output_spool_users = [0]
+_output_spool_lock = threading.Lock()
+
+
+def _with_output_spool(func):
+    """
+    Decorate a function executing hooks so that the spool file of their
+    output is closed once the outermost of them returns
+
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kwargs):
+        with _output_spool_lock:
+            _output_spool_users[0] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _output_spool_lock:
+                _output_spool_users[0] -= 1
+                last = _output_spool_users[0] <= 0
+            if last:
+                _close_output_spool()
+    return _wrapper
+
 
 def hook_add(app, file):
     """
@@ -55,9 +131,19 @@ def hook_add(app, file):
     try: os.listdir(custom_hook_folder + action)
     except OSError: os.makedirs(custom_hook_folder + action)
 
-    finalpath = custom_hook_folder + action +'/'+ priority +'-'+ app
-    os.system('cp %s %s' % (file, finalpath))
-    os.system('chown -hR admin: %s' % hook_folder)
+    hookname = priority +'-'+ app
+    finalpath = custom_hook_folder + action +'/'+ hookname
+    registry = _get_hooks_registry(action)
+
+    # Copy the hook next to its final path and rename it, so that it is
+    # replaced atomically - the hidden name prevents it from being listed
+    tmppath = custom_hook_folder + action +'/.'+ hookname +'.tmp'
+    shutil.copy(file, tmppath)
+    set_permissions(tmppath, [{'owner': 'admin'}])
+    os.rename(tmppath, finalpath)
+
+    registry['custom'].setdefault(priority, {})[app] = finalpath
+    _update_hooks_registry_mtimes(action, registry)
 
     return { 'hook': finalpath }
 
@@ -72,9 +158,13 @@ def hook_remove(app):
     """
     try:
         for action in os.listdir(custom_hook_folder):
+            registry = _get_hooks_registry(action)
             for script in os.listdir(custom_hook_folder + action):
                 if script.endswith(app):
                     os.remove(custom_hook_folder + action +'/'+ script)
+                    priority, name = _extract_filename_parts(script)
+                    registry['custom'].get(priority, {}).pop(name, None)
+            _update_hooks_registry_mtimes(action, registry)
     except OSError: pass
 
 
@@ -89,24 +179,22 @@ def hook_info(action, name):
     """
     hooks = []
     priorities = set()
+    registry = _get_hooks_registry(action)
 
     # Search in custom folder first
-    for h in iglob('{:s}{:s}/*-{:s}'.format(
-            custom_hook_folder, action, name)):
-        priority, _ = _extract_filename_parts(os.path.basename(h))
-        priorities.add(priority)
-        hooks.append({
-            'priority': priority,
-            'path': h,
-        })
+    for priority, names in sorted(registry['custom'].items()):
+        if name in names:
+            priorities.add(priority)
+            hooks.append({
+                'priority': priority,
+                'path': names[name],
+            })
     # Append non-overwritten system hooks
-    for h in iglob('{:s}{:s}/*-{:s}'.format(
-            hook_folder, action, name)):
-        priority, _ = _extract_filename_parts(os.path.basename(h))
-        if priority not in priorities:
+    for priority, names in sorted(registry['system'].items()):
+        if name in names and priority not in priorities:
             hooks.append({
                 'priority': priority,
-                'path': h,
+                'path': names[name],
             })
 
     if not hooks:
@@ -173,42 +261,32 @@ def hook_list(action, list_by='name', show_info=False):
     else:
         raise MoulinetteError(errno.EINVAL, m18n.n('hook_list_by_invalid'))
 
-    def _append_folder(d, folder):
-        # Iterate over and add hook from a folder
-        for f in os.listdir(folder + action):
-            if f[0] == '.' or f[-1] == '~':
-                continue
-            path = '%s%s/%s' % (folder, action, f)
-            priority, name = _extract_filename_parts(f)
-            _append_hook(d, priority, name, path)
+    registry = _get_hooks_registry(action)
 
-    try:
-        # Append system hooks first
-        if list_by == 'folder':
-            result['system'] = dict() if show_info else set()
-            _append_folder(result['system'], hook_folder)
-        else:
-            _append_folder(result, hook_folder)
-    except OSError:
-        logger.debug("system hook folder not found for action '%s' in %s",
-                     action, hook_folder)
+    def _append_folder(d, origin):
+        # Iterate over and add hook from a folder of the registry
+        for priority, names in sorted(registry[origin].items()):
+            for name, path in sorted(names.items()):
+                _append_hook(d, priority, name, path)
 
-    try:
-        # Append custom hooks
+    # Append system hooks first, then custom ones
+    for origin, folder in (('system', hook_folder),
+                           ('custom', custom_hook_folder)):
+        if registry['mtimes'][origin] is None:
+            logger.debug("%s hook folder not found for action '%s' in %s",
+                         origin, action, folder)
         if list_by == 'folder':
-            result['custom'] = dict() if show_info else set()
-            _append_folder(result['custom'], custom_hook_folder)
+            result[origin] = dict() if show_info else set()
+            _append_folder(result[origin], origin)
         else:
-            _append_folder(result, custom_hook_folder)
-    except OSError:
-        logger.debug("custom hook folder not found for action '%s' in %s",
-                     action, custom_hook_folder)
+            _append_folder(result, origin)
 
     return { 'hooks': result }
 
 
+@_with_output_spool
 def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
-                  pre_callback=None, post_callback=None):
+                  pre_callback=None, post_callback=None, jobs=None):
     """
     Execute all scripts binded to an action
 
@@ -223,6 +301,8 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
             the arguments to pass to the script
         post_callback -- An object to call after each script execution with
             (name, priority, path, succeed) as arguments
+        jobs -- Number of hooks of a same priority to execute in parallel,
+            priorities are still executed one after the other
 
     """
     result = { 'succeed': {}, 'failed': {} }
@@ -268,33 +348,53 @@ def hook_callback(action, hooks=[], args=None, no_trace=False, chdir=None,
     if not callable(post_callback):
         post_callback = lambda name, priority, path, succeed: None
 
-    # Iterate over hooks and execute them
-    for priority in sorted(hooks_dict):
-        for name, info in iter(hooks_dict[priority].items()):
-            state = 'succeed'
-            path = info['path']
-            try:
+    parallel = jobs is not None and jobs > 1
+    # Serialize callbacks calls and result updates between hooks threads
+    lock = threading.Lock()
+
+    def _run_hook(hook):
+        priority, name, path = hook
+        state = 'succeed'
+        try:
+            with lock:
                 hook_args = pre_callback(name=name, priority=priority,
                                          path=path, args=args)
-                hook_exec(path, args=hook_args, chdir=chdir,
-                          no_trace=no_trace, raise_on_error=True)
-            except MoulinetteError as e:
-                state = 'failed'
-                logger.error(str(e))
-                post_callback(name=name, priority=priority, path=path,
-                              succeed=False)
-            else:
-                post_callback(name=name, priority=priority, path=path,
-                              succeed=True)
+            # Prefix the output of each hook by its name if they are
+            # executed concurrently
+            hook_exec(path, args=hook_args, chdir=chdir,
+                      no_trace=no_trace, raise_on_error=True,
+                      output_prefix='[{0}] '.format(name) if parallel else None)
+        except MoulinetteError as e:
+            state = 'failed'
+            logger.error(str(e))
+        with lock:
+            post_callback(name=name, priority=priority, path=path,
+                          succeed=(state == 'succeed'))
             try:
                 result[state][name].append(path)
             except KeyError:
                 result[state][name] = [path]
+
+    # Iterate over hooks and execute them
+    for priority in sorted(hooks_dict):
+        bucket = [(priority, name, info['path'])
+                 for name, info in hooks_dict[priority].items()]
+        if not parallel or len(bucket) == 1:
+            for hook in bucket:
+                _run_hook(hook)
+            continue
+        pool = ThreadPool(min(jobs, len(bucket)))
+        try:
+            pool.map(_run_hook, bucket)
+        finally:
+            pool.close()
+            pool.join()
     return result
 
 
+@_with_output_spool
 def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
-              chdir=None, env=None):
+              chdir=None, env=None, output_prefix=None):
     """
     Execute hook from a file with arguments
 
@@ -305,6 +405,7 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
         no_trace -- Do not print each command that will be executed
         chdir -- The directory from where the script will be executed
         env -- Dictionnary of environment variables to export
+        output_prefix -- A string to prepend to each logged output line
 
     """
     from moulinette.utils.process import call_async_output
@@ -317,44 +418,82 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
         raise MoulinetteError(errno.EIO, m18n.g('file_not_exist'))
 
     # Construct command variables
-    cmd_args = ''
-    if args and isinstance(args, list):
-        # Concatenate arguments and escape them with double quotes to prevent
-        # bash related issue if an argument is empty and is not the last
-        cmd_args = '"{:s}"'.format('" "'.join(str(s) for s in args))
     if not chdir:
         # use the script directory as current one
         chdir, cmd_script = os.path.split(path)
         cmd_script = './{0}'.format(cmd_script)
     else:
         cmd_script = path
-
-    # Construct command to execute
-    command = ['sudo', '-n', '-u', 'admin', '-H', 'sh', '-c']
-    if no_trace:
-        cmd = '/bin/bash "{script}" {args}'
+    cmd_args = []
+    if args and isinstance(args, list):
+        cmd_args = [str(s) for s in args]
+
+    credentials = None
+    if os.geteuid() == 0 and os.access(hook_exec_setpriv, os.X_OK):
+        try:
+            credentials = _get_user_credentials(hook_exec_user)
+        except KeyError:
+            logger.warning("unable to retrieve the user '%s'",
+                           hook_exec_user)
+
+    if credentials is not None:
+        # Execute bash directly as the hook user instead of going through
+        # sudo and sh
+        cmd_env = _make_hook_exec_env(credentials)
+        for k, v in (env or {}).items():
+            cmd_env[str(k)] = str(v)
+        exec_kwargs = {'env': cmd_env}
+        if no_trace:
+            command = ['/bin/bash', cmd_script] + cmd_args
+        else:
+            # use xtrace on fd 7 which is redirected to stdout
+            command = ['/bin/bash', '-x', cmd_script] + cmd_args
+            cmd_env['BASH_XTRACEFD'] = '7'
+            exec_kwargs['preexec_fn'] = _redirect_xtrace_fd
+        cmd_repr = ' '.join(
+            ['{0}={1}'.format(k, pipes.quote(v)) for k, v in
+             (env or {}).items()] + [pipes.quote(a) for a in command])
+        command = _make_exec_as_user(credentials) + command
     else:
-        # use xtrace on fd 7 which is redirected to stdout
-        cmd = 'BASH_XTRACEFD=7 /bin/bash -x "{script}" {args} 7>&1'
-    if env:
-        # prepend environment variables
-        cmd = '{0} {1}'.format(
-            ' '.join(['{0}="{1}"'.format(k, v) for k, v in env.items()]), cmd)
-    command.append(cmd.format(script=cmd_script, args=cmd_args))
+        # Quote arguments so that they are passed as is - even if empty
+        cmd_args = ' '.join(pipes.quote(a) for a in cmd_args)
+
+        # Construct command to execute
+        command = ['sudo', '-n', '-u', hook_exec_user, '-H', 'sh', '-c']
+        if no_trace:
+            cmd = '/bin/bash {script} {args}'
+        else:
+            # use xtrace on fd 7 which is redirected to stdout
+            cmd = 'BASH_XTRACEFD=7 /bin/bash -x {script} {args} 7>&1'
+        if env:
+            # prepend environment variables
+            cmd = '{0} {1}'.format(
+                ' '.join(['{0}={1}'.format(k, pipes.quote(str(v)))
+                          for k, v in env.items()]), cmd)
+        command.append(cmd.format(script=pipes.quote(cmd_script),
+                                  args=cmd_args))
+        exec_kwargs = {}
+        cmd_repr = ' '.join(command)
 
     if logger.isEnabledFor(log.DEBUG):
-        logger.info(m18n.n('executing_command', command=' '.join(command)))
+        logger.info(m18n.n('executing_command', command=cmd_repr))
     else:
         logger.info(m18n.n('executing_script', script=path))
 
     # Define output callbacks and call command
-    callbacks = (
-        lambda l: logger.info(l.rstrip()),
-        lambda l: logger.warning(l.rstrip()),
-    )
-    returncode = call_async_output(
-        command, callbacks, shell=False, cwd=chdir
-    )
+    output = HookOutputCapture(path, prefix=output_prefix)
+    callbacks = (output.stdout, output.stderr)
+    started_at = time.time()
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        returncode = call_async_output(
+            command, callbacks, shell=False, cwd=chdir, **exec_kwargs
+        )
+    finally:
+        output.close()
+    _record_hook_stats(path, started_at, returncode, rusage)
+    if returncode != 0:
+        output.report_tail()
 
     # Check and return process' return code
     if returncode is None:
@@ -368,6 +507,413 @@ def hook_exec(path, args=None, raise_on_error=False, no_trace=False,
     return returncode
 
 
+def hook_stats(action=None, name=None, limit=10):
+    """
+    Show statistics of hooks executions
+
+    Keyword argument:
+        action -- Only show hooks of this action
+        name -- Only show hooks with this name
+        limit -- Number of slowest recent executions to show
+
+    """
+    limit = int(limit) if limit is not None else 10
+    records = [r for r in _read_hook_stats()
+               if (action is None or r['action'] == action)
+               and (name is None or r['name'] == name)]
+
+    # Group executions wall times by hook
+    times = {}
+    failures = {}
+    for r in records:
+        key = (r['action'], r['name'])
+        times.setdefault(key, []).append(r['time'])
+        if r['returncode'] != 0:
+            failures[key] = failures.get(key, 0) + 1
+
+    def _percentile(values, p):
+        # nearest-rank percentile of sorted values
+        return values[max(0, int(round(p / 100. * len(values))) - 1)]
+
+    hooks = []
+    for (hook_action, hook_name), values in sorted(times.items()):
+        values.sort()
+        hooks.append({
+            'action': hook_action,
+            'name': hook_name,
+            'count': len(values),
+            'failed': failures.get((hook_action, hook_name), 0),
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'max': values[-1],
+        })
+
+    # Slowest executions among the most recent ones
+    recent = records[-max(limit * 10, 100):]
+    slowest = sorted(recent, key=lambda r: r['time'], reverse=True)[:limit]
+
+    return {'hooks': hooks, 'slowest': slowest}
+
+
+class HookOutputCapture(object):
+    """Capture the output of a hook execution
+
+    Each line is written to the spool file of the current operation - which
+    keeps the full output compressed - and the last ones are kept in a
+    bounded buffer. Lines are logged grouped in batches - of consecutive
+    lines of the same stream - and at a limited rate: lines beyond it are
+    not logged, but counted and reported once the hook has terminated.
+
+    Keyword arguments:
+        path -- The path of the hook
+        prefix -- A string to prepend to each logged line
+
+    """
+
+    def __init__(self, path, prefix=None):
+        self.path = path
+        self.prefix = prefix or ''
+        self.tail = deque(maxlen=hook_output_tail_size)
+        self.omitted = 0
+        self._batch = []
+        self._batch_level = None
+        self._batch_started = 0
+        self._tokens = hook_output_burst
+        self._last_refill = time.time()
+
+    def stdout(self, line):
+        self._capture(log.INFO, line)
+
+    def stderr(self, line):
+        self._capture(log.WARNING, line)
+
+    def _capture(self, level, line):
+        line = line.rstrip()
+        self.tail.append(line)
+        _write_to_output_spool('{0} {1}: {2}\n'.format(
+            'E' if level == log.WARNING else 'O', self.path, line))
+
+        # Refill the rate limiter tokens
+        now = time.time()
+        self._tokens = min(hook_output_burst, self._tokens +
+                           (now - self._last_refill) * hook_output_rate)
+        self._last_refill = now
+        if self._tokens < 1:
+            self.omitted += 1
+            return
+        self._tokens -= 1
+
+        if level != self._batch_level or \
+                len(self._batch) >= hook_output_batch_size or \
+                now - self._batch_started >= hook_output_batch_delay:
+            self.flush()
+            self._batch_level = level
+            self._batch_started = now
+        self._batch.append(self.prefix + line)
+
+    def flush(self):
+        """Log the pending batch of lines"""
+        if self._batch:
+            logger.log(self._batch_level, '\n'.join(self._batch))
+            self._batch = []
+
+    def close(self):
+        """Flush pending lines and report omitted ones"""
+        self.flush()
+        _write_to_output_spool(None)
+        if self.omitted:
+            logger.warning(m18n.n('hook_output_omitted', count=self.omitted,
+                                  path=self.path,
+                                  spool=_output_spool.get('path', '')))
+
+    def report_tail(self):
+        """Log the last lines of output if some have been omitted"""
+        if self.omitted and self.tail:
+            logger.warning('{0}\n{1}'.format(
+                m18n.n('hook_output_tail', path=self.path),
+                '\n'.join(self.prefix + l for l in self.tail)))
+
+
+def _write_to_output_spool(data):
+    """
+    Write data to the hooks output spool file of the current operation, or
+    flush it if `data` is None
+
+    The file is created on first write - and again in a forked process -
+    and older spool files are removed to keep only the last
+    `hook_output_spool_keep` ones. It is closed by _close_output_spool.
+
+    """
+    with _output_spool_lock:
+        if _output_spool.get('pid') != os.getpid():
+            if data is None:
+                return
+            _output_spool.clear()
+            try:
+                _output_spool.update(_open_output_spool())
+            except (IOError, OSError):
+                logger.debug("unable to open the hooks output spool",
+                             exc_info=1)
+                _output_spool['pid'] = os.getpid()
+        f = _output_spool.get('file')
+        if f is None:
+            return
+        if data is None:
+            f.flush()
+        else:
+            f.write(data)
+
+
+def _open_output_spool():
+    if not os.path.isdir(hook_output_spool_dir):
+        os.makedirs(hook_output_spool_dir, 0750)
+
+    # Remove older spool files
+    spools = sorted(f for f in os.listdir(hook_output_spool_dir)
+                    if f.endswith('.log.gz'))
+    for f in spools[:max(0, len(spools) - hook_output_spool_keep + 1)]:
+        try:
+            os.remove(os.path.join(hook_output_spool_dir, f))
+        except OSError:
+            pass
+
+    # A process may execute several operations within the same second
+    now = time.time()
+    path = os.path.join(hook_output_spool_dir, '{0}.{1:06d}-{2}.log.gz'.format(
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+        int(now % 1 * 1000000), os.getpid()))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    raw = os.fdopen(fd, 'wb')
+    f = gzip.GzipFile(filename='', mode='wb', fileobj=raw)
+    return {'pid': os.getpid(), 'path': path, 'file': f, 'raw': raw}
+
+
+def _close_output_spool():
+    """
+    Close the hooks output spool file of the current operation if any - it
+    must be called before exiting with os._exit
+
+    """
+    with _output_spool_lock:
+        # Do not close the file of the parent in a forked process
+        if _output_spool.get('pid') != os.getpid():
+            return
+        spool = dict(_output_spool)
+        _output_spool.clear()
+    try:
+        if spool.get('file') is not None:
+            spool['file'].close()
+            spool['raw'].close()
+    except (IOError, ValueError):
+        pass
+
+atexit.register(_close_output_spool)
+
+
+def _record_hook_stats(path, started_at, returncode, rusage):
+    """
+    Append the statistics of a hook execution to the stats file
+
+    The action and the name of the hook are taken from its path. The
+    resources usage is computed from the one of all terminated children,
+    so it is approximative if several hooks are executed concurrently.
+    The maximum resident set size of the children is the one over the
+    process lifetime: it is only recorded when the execution raised it.
+
+    Keyword arguments:
+        path -- The path of the hook
+        started_at -- The time when the execution started
+        returncode -- The exit code of the hook
+        rusage -- The children resources usage before the execution
+
+    """
+    now = time.time()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    priority, name = _extract_filename_parts(os.path.basename(path))
+    record = '\t'.join(str(v) for v in (
+        int(started_at),
+        os.path.basename(os.path.dirname(path)),
+        name,
+        priority,
+        '%.3f' % (now - started_at),
+        returncode if returncode is not None else -1,
+        '%.3f' % (after.ru_utime - rusage.ru_utime),
+        '%.3f' % (after.ru_stime - rusage.ru_stime),
+        after.ru_maxrss if after.ru_maxrss > rusage.ru_maxrss else '',
+        after.ru_inblock - rusage.ru_inblock,
+        after.ru_oublock - rusage.ru_oublock,
+    )) + '\n'
+
+    try:
+        try:
+            if os.path.getsize(hook_stats_path) > hook_stats_max_size:
+                os.rename(hook_stats_path, hook_stats_path + '.1')
+        except OSError:
+            pass
+        # Append the record with a single write
+        fd = os.open(hook_stats_path,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0640)
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+    except OSError:
+        logger.debug("unable to record hook stats in %s", hook_stats_path,
+                     exc_info=1)
+
+
+def _read_hook_stats():
+    """Return the recorded hooks executions, from the oldest one"""
+    fields = ('started_at', 'action', 'name', 'priority', 'time',
+              'returncode', 'utime', 'stime', 'lifetime_maxrss', 'inblock',
+              'oublock')
+    _int_or_none = lambda v: int(v) if v else None
+    converters = (int, str, str, str, float, int, float, float,
+                  _int_or_none, int, int)
+    records = []
+    for stats_path in (hook_stats_path + '.1', hook_stats_path):
+        try:
+            with open(stats_path) as f:
+                for line in f:
+                    values = line.rstrip('\n').split('\t')
+                    if len(values) != len(fields):
+                        continue
+                    try:
+                        records.append(dict(zip(fields, [
+                            c(v) for c, v in zip(converters, values)])))
+                    except ValueError:
+                        continue
+        except IOError:
+            pass
+    return records
+
+
+def _get_user_credentials(username):
+    """
+    Return the uid, gid, supplementary groups, home directory and shell of
+    a user - cached by process
+
+    """
+    try:
+        return _users_credentials[username]
+    except KeyError:
+        pass
+    pw = pwd.getpwnam(username)
+    groups = set([pw.pw_gid])
+    for gr in grp.getgrall():
+        if username in gr.gr_mem:
+            groups.add(gr.gr_gid)
+    credentials = {
+        'name': username,
+        'uid': pw.pw_uid,
+        'gid': pw.pw_gid,
+        'groups': sorted(groups),
+        'home': pw.pw_dir,
+        'shell': pw.pw_shell,
+    }
+    _users_credentials[username] = credentials
+    return credentials
+
+
+def _make_hook_exec_env(credentials):
+    """Return the base environment of a hook executed as the given user"""
+    env = dict((k, v) for k, v in os.environ.items()
+               if k in hook_exec_env_keep or k.startswith('LC_'))
+    env.update({
+        'HOME': credentials['home'],
+        'USER': credentials['name'],
+        'LOGNAME': credentials['name'],
+        'SHELL': credentials['shell'],
+        'PATH': hook_exec_path,
+    })
+    return env
+
+
+def _make_exec_as_user(credentials):
+    """
+    Return the command prefix which executes a command as the user -
+    setting its groups, gid and uid as initgroups, setgid and setuid would
+    do - so that the user databases are not looked up in the forked child
+    before the exec, which would not be safe when hooks are executed from
+    several threads
+
+    """
+    return [
+        hook_exec_setpriv,
+        '--reuid={0}'.format(credentials['uid']),
+        '--regid={0}'.format(credentials['gid']),
+        '--groups={0}'.format(','.join(str(g) for g in credentials['groups'])),
+        '--',
+    ]
+
+
+def _redirect_xtrace_fd():
+    """
+    Duplicate the standard output of the forked child on the fd 7 used by
+    bash for its xtrace output - it only makes an async-signal-safe dup2,
+    as subprocess does itself for the standard streams
+
+    """
+    os.dup2(1, 7)
+
+
+def _get_hooks_registry(action):
+    """
+    Return the registry of the hooks of an action
+
+    The hooks of each action are listed once by process and cached until
+    the modification time of one of their folders changes. The registry
+    contains the hooks paths by priority and name, for both the 'system'
+    and the 'custom' folders, and the 'mtimes' of these folders - which
+    are None if they do not exist.
+
+    Keyword argument:
+        action -- Action name
+
+    """
+    mtimes = {
+        'system': _get_folder_mtime(hook_folder + action),
+        'custom': _get_folder_mtime(custom_hook_folder + action),
+    }
+    registry = _hooks_registry.get(action)
+    if registry is None or registry['mtimes'] != mtimes:
+        registry = {
+            'mtimes': mtimes,
+            'system': _list_hooks_folder(hook_folder + action),
+            'custom': _list_hooks_folder(custom_hook_folder + action),
+        }
+        _hooks_registry[action] = registry
+    return registry
+
+
+def _update_hooks_registry_mtimes(action, registry):
+    """Record the custom folder mtime once the registry has been updated"""
+    registry['mtimes']['custom'] = _get_folder_mtime(
+        custom_hook_folder + action)
+
+
+def _get_folder_mtime(folder):
+    try:
+        return os.stat(folder).st_mtime
+    except OSError:
+        return None
+
+
+def _list_hooks_folder(folder):
+    """Return the hooks paths by priority and name of a folder"""
+    hooks = {}
+    try:
+        filenames = os.listdir(folder)
+    except OSError:
+        return hooks
+    for f in filenames:
+        if f[0] == '.' or f[-1] == '~':
+            continue
+        priority, name = _extract_filename_parts(f)
+        hooks.setdefault(priority, {})[name] = '%s/%s' % (folder, f)
+    return hooks
+
+
 def _extract_filename_parts(filename):
     """Extract hook parts from filename"""
     if '-' in filename:
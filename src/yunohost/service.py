@@ -272,7 +272,7 @@ def service_log(name, number=50):
 
 
 def service_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
-                       list_pending=False):
+                       list_pending=False, jobs=None):
     """
     Regenerate the configuration file(s) for a service
 
@@ -282,6 +282,7 @@ def service_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
         force -- Override all manual modifications in configuration files
         dry_run -- Show what would have been regenerated
         list_pending -- List pending configuration files and exit
+        jobs -- Number of hooks of a same priority to execute in parallel
 
     """
     result = {}
@@ -314,7 +315,8 @@ def service_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
         filesystem.mkdir(service_pending_path, 0755, True, uid='admin')
         # return the arguments to pass to the script
         return pre_args + [service_pending_path,]
-    pre_result = hook_callback('conf_regen', names, pre_callback=_pre_call)
+    pre_result = hook_callback('conf_regen', names, pre_callback=_pre_call,
+                               jobs=jobs)
 
     # Update the services name
     names = pre_result['succeed'].keys()
@@ -458,7 +460,7 @@ def service_regen_conf(names=[], with_diff=False, force=False, dry_run=False,
         else:
             regen_conf_files = ''
         return post_args + [regen_conf_files,]
-    hook_callback('conf_regen', names, pre_callback=_pre_call)
+    hook_callback('conf_regen', names, pre_callback=_pre_call, jobs=jobs)
 
     return result
 
@@ -0,0 +1,83 @@
+"""
+Benchmark of the listing of installed apps
+
+It times app_list - with the installed apps info resolved in one pass -
+for an increasing number of installed instances of a same app, from
+scratch settings and lists directories, to check that it stays linear:
+
+    python src/yunohost/tests/bench_app_list.py [-n COUNT]...
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import moulinette
+
+
+def _install_instances(app, count):
+    with open(os.path.join(app.repo_path, 'yunohost.json'), 'w') as f:
+        json.dump({'wp': {
+            'manifest': {'id': 'wp', 'name': 'WP', 'description': 'Blog',
+                         'multi_instance': 'true'},
+            'lastUpdate': 1, 'git': {},
+        }}, f)
+    for i in range(count):
+        app_id = 'wp' if i == 0 else 'wp__%d' % (i + 1)
+        path = os.path.join(app.apps_setting_path, app_id)
+        os.makedirs(path)
+        with open(os.path.join(path, 'settings.yml'), 'w') as f:
+            yaml.safe_dump({'id': app_id, 'label': app_id,
+                            'install_time': 0}, f)
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump({'id': 'wp', 'name': 'WP'}, f)
+        with open(os.path.join(path, 'status.json'), 'w') as f:
+            json.dump({'installed_at': 0}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, action='append')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    moulinette.init(_from_source=False)
+    from yunohost import app
+    app.logger.disabled = True
+
+    for count in options.count or [10, 50, 100, 250, 500]:
+        tmp = tempfile.mkdtemp()
+        try:
+            app.repo_path = os.path.join(tmp, 'repo')
+            app.appslist_index = os.path.join(tmp, 'index')
+            app.instances_registry = os.path.join(tmp, 'instances.json')
+            app.apps_setting_path = os.path.join(tmp, 'apps/')
+            os.makedirs(app.repo_path)
+            os.makedirs(app.apps_setting_path)
+            _install_instances(app, count)
+            app._appslist_index_cache.clear()
+
+            # The first listing builds the index and warms the caches
+            app.app_list()
+            times = []
+            for i in range(options.repeat):
+                started_at = time.time()
+                app.app_list()
+                times.append(time.time() - started_at)
+            best = min(times) * 1000
+            print '{0:4d} instances: {1:8.1f} ms, {2:6.3f} ms by instance' \
+                .format(count, best, best / count)
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of the spawn overhead of a hook
+
+It compares the commands used to execute a traced hook as another user:
+the original sudo, sh and bash chain - if sudo is installed - the setpriv
+and bash chain which preceded the current command, and the current one,
+alone and through hook_exec. It must be run as root:
+
+    python src/yunohost/tests/bench_hook_exec.py [-n COUNT] [-u USER]
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import moulinette
+
+
+def _timeit(count, func):
+    started_at = time.time()
+    for i in range(count):
+        func()
+    return (time.time() - started_at) / count * 1000
+
+
+def _spawn(command, **kwargs):
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, **kwargs)
+    p.communicate()
+    assert p.returncode == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200)
+    parser.add_argument('-u', '--user', default='nobody')
+    options = parser.parse_args()
+
+    moulinette.init(_from_source=False)
+    from yunohost import hook
+    hook.hook_exec_user = options.user
+    hook.logger.disabled = True
+
+    credentials = hook._get_user_credentials(options.user)
+    env = hook._make_hook_exec_env(credentials)
+    as_user = hook._make_exec_as_user(credentials)
+
+    tmp = tempfile.mkdtemp()
+    os.chmod(tmp, 0755)
+    hook.hook_output_spool_dir = os.path.join(tmp, 'spool')
+    hook.hook_stats_path = os.path.join(tmp, 'stats')
+    script = os.path.join(tmp, 'hook')
+    with open(script, 'w') as f:
+        f.write('#!/bin/bash\ntrue "$1"\n')
+    os.chmod(script, 0755)
+
+    benchmarks = []
+    if find_executable('sudo'):
+        benchmarks.append(('sudo, sh and bash (original)', lambda: _spawn([
+            'sudo', '-n', '-u', options.user, '-H', 'sh', '-c',
+            'YNH_ARG="value" BASH_XTRACEFD=7 /bin/bash -x "{0}" "arg" 7>&1'
+            .format(script)])))
+    else:
+        print "sudo is not installed, the original command is skipped"
+    benchmarks += [
+        ('setpriv, bash and bash (previous)', lambda: _spawn(as_user + [
+            '/bin/bash', '-c',
+            'exec 7>&1 && BASH_XTRACEFD=7 exec /bin/bash -x "$@"',
+            'bash', script, 'arg'], env=dict(env, YNH_ARG='value'))),
+        ('setpriv and bash (current)', lambda: _spawn(as_user + [
+            '/bin/bash', '-x', script, 'arg'],
+            env=dict(env, YNH_ARG='value', BASH_XTRACEFD='7'),
+            preexec_fn=hook._redirect_xtrace_fd)),
+        ('hook_exec', lambda: hook.hook_exec(
+            script, args=['arg'], env={'YNH_ARG': 'value'})),
+    ]
+    try:
+        for name, func in benchmarks:
+            func()
+            print '{0:<36} {1:6.2f} ms'.format(name, _timeit(options.count, func))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark of the retrieval of installed packages versions
+
+It compares the previous way - loading the apt cache on each call - with
+the dpkg status index, when it is built from the status file and once it
+is cached, for the given packages:
+
+    python src/yunohost/tests/bench_packages.py [-n COUNT] [PACKAGE...]
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import moulinette
+
+DEFAULT_PACKAGES = ['bash', 'coreutils', 'dpkg', 'libc6', 'python3']
+
+
+def _median(count, func):
+    times = []
+    for i in range(count):
+        started_at = time.time()
+        result = func()
+        times.append(time.time() - started_at)
+    times.sort()
+    return times[len(times) // 2], result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=10)
+    parser.add_argument('packages', nargs='*', default=DEFAULT_PACKAGES)
+    options = parser.parse_args()
+
+    moulinette.init(_from_source=False)
+    from yunohost.utils import packages
+
+    def _from_apt_cache():
+        cache = packages.apt.Cache()
+        return dict((p, cache[p].installed.version) for p in options.packages)
+
+    def _from_dpkg_status(cached):
+        if not cached:
+            packages._dpkg_status_index = (None, {})
+        return dict(packages.get_installed_version(*options.packages,
+                                                   as_dict=True))
+
+    print('{0} packages indexed from {1}'.format(
+        len(packages.get_dpkg_status_index()), packages.DPKG_STATUS_PATH))
+    apt_time, apt_versions = _median(options.count, _from_apt_cache)
+    cold_time, cold_versions = _median(
+        options.count, lambda: _from_dpkg_status(False))
+    cached_time, cached_versions = _median(
+        options.count * 100, lambda: _from_dpkg_status(True))
+    assert apt_versions == cold_versions == cached_versions, \
+        (apt_versions, cold_versions)
+
+    print('apt cache, loaded on each call   {0:10.3f} ms'.format(apt_time * 1000))
+    print('dpkg status index, built         {0:10.3f} ms'.format(cold_time * 1000))
+    print('dpkg status index, cached        {0:10.3f} ms'.format(cached_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of the cold start of yunohost-query against yunohost
+
+It runs each read-only query with both commands - in plain output - as
+many times as given, checks that their outputs are the same and prints
+the median wall time of a run:
+
+    python src/yunohost/tests/bench_query.py [-n COUNT] [QUERY...]
+
+A query is given as one argument, e.g. 'app setting wordpress domain'.
+
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', '..', 'bin')
+
+DEFAULT_QUERIES = ['tools maindomain', 'domain list']
+
+
+def _run(command, count):
+    times = []
+    output = None
+    for i in range(count + 1):
+        started_at = time.time()
+        p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0], p.returncode
+        # Skip the first run which warms the page cache
+        if i:
+            times.append(time.time() - started_at)
+    times.sort()
+    return times[len(times) // 2] * 1000, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=20)
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+    options = parser.parse_args()
+
+    print '{0:<36} {1:>14} {2:>14}'.format('query', 'yunohost-query', 'yunohost')
+    for query in options.queries:
+        args = query.split() + ['--output-as', 'plain']
+        results = [_run([sys.executable, os.path.join(BIN_DIR, name)] + args,
+                        options.count)
+                   for name in ('yunohost-query', 'yunohost')]
+        print '{0:<36} {1:11.1f} ms {2:11.1f} ms{3}'.format(
+            query, results[0][0], results[1][0],
+            '' if results[0][1] == results[1][1] else '  (outputs differ)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+import moulinette
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+def pytest_configure(config):
+    moulinette.init(_from_source=False)
+    moulinette.m18n.load_namespace('yunohost')
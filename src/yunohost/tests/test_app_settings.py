@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+import pytest
+
+from yunohost import app
+
+
+@pytest.fixture
+def installed_app(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    monkeypatch.setattr(app, 'apps_setting_path', os.path.join(tmp, 'apps/'))
+    os.makedirs(os.path.join(app.apps_setting_path, 'foo'))
+    app._set_app_settings('foo', {'id': 'foo', 'domain': 'a.tld',
+                                  'path': '/foo'})
+    yield 'foo'
+    shutil.rmtree(tmp)
+
+
+def test_app_settings_bulk_values_and_delete(installed_app):
+    assert app.app_settings_bulk(
+        installed_app, values=['path=/bar', 'final_path=/var/www/a=b'],
+        delete=['domain']) is None
+
+    settings = app._get_app_settings(installed_app)
+    assert settings['path'] == '/bar'
+    assert settings['final_path'] == '/var/www/a=b'
+    assert 'domain' not in settings
+
+
+def test_app_settings_bulk_get(installed_app):
+    assert app.app_settings_bulk(installed_app, get=['path', 'unset']) == \
+        {'path': '/foo', 'unset': None}
+    assert list(app.app_settings_bulk(installed_app)) == \
+        ['domain', 'id', 'path']
+
+
+def test_app_settings_bulk_shell(installed_app):
+    app.app_settings_bulk(installed_app, values=["label=it's $HOME"])
+    assignments = app.app_settings_bulk(
+        installed_app, get=['label', 'path', 'unset'], shell=True)
+
+    output = subprocess.check_output(
+        ['bash', '-c', 'eval "$1"; echo "$label|$path|$unset"', 'bash',
+         assignments])
+    assert output == "it's $HOME|/foo|\n"
+
+
+def test_app_settings_bulk_invalid_value(installed_app):
+    with pytest.raises(app.MoulinetteError):
+        app.app_settings_bulk(installed_app, values=['path'])
+
+
+def test_app_settings_copies_do_not_alter_cache(installed_app):
+    app._set_app_settings(installed_app, {
+        'id': installed_app, 'path': '/foo',
+        'redirected_urls': {'a.tld/old': 'a.tld/new'}})
+
+    settings = app._get_app_settings(installed_app)
+    settings['path'] = '/bar'
+    settings['redirected_urls']['a.tld/other'] = 'a.tld/new'
+    del settings['id']
+
+    assert app._get_app_settings(installed_app) == {
+        'id': installed_app, 'path': '/foo',
+        'redirected_urls': {'a.tld/old': 'a.tld/new'}}
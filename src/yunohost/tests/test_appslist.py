@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+
+import pytest
+
+from yunohost import app
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Sat, 01 Jan 2000 00:00:00 GMT'
+APPSLIST = {
+    'foo': {
+        'manifest': {'id': 'foo', 'name': 'Foo', 'description': 'Foo app'},
+        'lastUpdate': 1,
+    },
+}
+
+
+class AppslistHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve an apps list which honours conditional requests"""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG or \
+                self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(APPSLIST)
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    del AppslistHandler.requests[:]
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), AppslistHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/official.json' % httpd.server_port
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def sandbox(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp, 'apps'))
+    monkeypatch.setattr(app, 'repo_path', os.path.join(tmp, 'repo'))
+    monkeypatch.setattr(app, 'appslist_index', os.path.join(tmp, 'index'))
+    monkeypatch.setattr(app, 'upgrades_index', os.path.join(tmp, 'upgrades'))
+    monkeypatch.setattr(app, 'apps_setting_path', os.path.join(tmp, 'apps/'))
+    # Do not write the cron jobs of the lists
+    monkeypatch.setattr(os, 'system', lambda cmd: 0)
+    builds = []
+    build_appslist_index = app._build_appslist_index
+    monkeypatch.setattr(app, '_build_appslist_index',
+                        lambda: builds.append(1) or build_appslist_index())
+    yield builds
+    shutil.rmtree(tmp)
+
+
+def test_fetchlist_conditional_get(server, sandbox):
+    app.app_fetchlist(url=server, name='yunohost')
+
+    requests = AppslistHandler.requests
+    assert 'if-none-match' not in requests[0]
+    assert 'if-modified-since' not in requests[0]
+    with open(os.path.join(app.repo_path, 'yunohost.validators')) as f:
+        assert json.load(f) == {
+            'url': server, 'etag': ETAG, 'last_modified': LAST_MODIFIED}
+    assert sandbox == [1]
+
+    mtime = os.stat(os.path.join(app.repo_path, 'yunohost.json')).st_mtime
+    app.app_fetchlist(url=server, name='yunohost')
+
+    assert requests[1]['if-none-match'] == ETAG
+    assert requests[1]['if-modified-since'] == LAST_MODIFIED
+    assert os.stat(
+        os.path.join(app.repo_path, 'yunohost.json')).st_mtime == mtime
+    assert sandbox == [1]
+    assert [a['id'] for a in app.app_list()['apps']] == ['foo']
+
+
+def test_fetchlist_validators_of_another_url(server, sandbox):
+    app.app_fetchlist(url=server, name='yunohost')
+    app.app_fetchlist(url=server + '?mirror', name='yunohost')
+
+    requests = AppslistHandler.requests
+    assert 'if-none-match' not in requests[1]
+    assert 'if-modified-since' not in requests[1]
+    assert sandbox == [1, 1]
+
+
+def test_fetchlist_all_registered_lists(server, sandbox, monkeypatch):
+    monkeypatch.setattr(app, '_get_registered_appslists', lambda: app.OrderedDict(
+        [('one', server), ('two', server + '?two')]))
+    app.app_fetchlist()
+
+    assert sorted(app.app_listlists()['lists']) == ['one', 'two']
+    assert len(AppslistHandler.requests) == 2
+    assert sandbox == [1]
+
+
+def test_fetchlist_url_without_name(server, sandbox):
+    with pytest.raises(app.MoulinetteError):
+        app.app_fetchlist(url=server)
@@ -0,0 +1,98 @@
+import os
+import pwd
+import shutil
+import tempfile
+
+import pytest
+
+from yunohost import hook
+
+HOOK_SCRIPT = """#!/bin/bash
+echo "1=$1"
+echo "2=$2"
+echo "3=$3"
+echo "YNH_TEST=$YNH_TEST"
+echo "user=$(id -un)"
+"""
+
+
+def _has_user(name):
+    try:
+        pwd.getpwnam(name)
+    except KeyError:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(
+    os.geteuid() != 0 or not os.access(hook.hook_exec_setpriv, os.X_OK) or
+    not _has_user('nobody'),
+    reason="hooks are executed as another user with setpriv by root")
+
+
+class RecordingLogger(object):
+
+    def __init__(self):
+        self.records = []
+
+    def isEnabledFor(self, level):
+        return True
+
+    def log(self, level, msg, *args, **kwargs):
+        self.records.append((level, msg))
+
+    def info(self, msg, *args, **kwargs):
+        self.log(hook.log.INFO, msg)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(hook.log.WARNING, msg)
+
+    debug = error = info
+
+    def output(self, level):
+        return '\n'.join(m for l, m in self.records if l == level).split('\n')
+
+
+@pytest.fixture
+def hook_sandbox(monkeypatch):
+    tmp = tempfile.mkdtemp()
+    os.chmod(tmp, 0755)
+    monkeypatch.setattr(hook, 'hook_exec_user', 'nobody')
+    monkeypatch.setattr(hook, 'hook_output_spool_dir', os.path.join(tmp, 'spool'))
+    monkeypatch.setattr(hook, 'hook_stats_path', os.path.join(tmp, 'stats'))
+    logger = RecordingLogger()
+    monkeypatch.setattr(hook, 'logger', logger)
+    path = os.path.join(tmp, 'hook')
+    with open(path, 'w') as f:
+        f.write(HOOK_SCRIPT)
+    os.chmod(path, 0755)
+    yield path, logger
+    shutil.rmtree(tmp)
+
+
+@pytest.mark.parametrize('no_trace', [False, True])
+def test_hook_exec_passes_values_as_is(hook_sandbox, no_trace):
+    path, logger = hook_sandbox
+    args = ['$HOME', '', '`id` "a b" \\']
+    assert hook.hook_exec(path, args=args, env={'YNH_TEST': '$(id) ;'},
+                          no_trace=no_trace) == 0
+
+    stdout = logger.output(hook.log.INFO)
+    assert '1=$HOME' in stdout
+    assert '2=' in stdout
+    assert '3=`id` "a b" \\' in stdout
+    assert 'YNH_TEST=$(id) ;' in stdout
+    assert 'user=nobody' in stdout
+    assert ('+ echo 2=' in stdout) is not no_trace
+    assert not [l for l in logger.output(hook.log.WARNING) if l]
+
+
+def test_hook_exec_trace_follows_original_stdout(hook_sandbox):
+    path, logger = hook_sandbox
+    with open(path, 'w') as f:
+        f.write('#!/bin/bash\nexec >/dev/null\necho hidden\n')
+
+    assert hook.hook_exec(path) == 0
+    stdout = logger.output(hook.log.INFO)
+    assert '+ echo hidden' in stdout
+    assert 'hidden' not in stdout
@@ -0,0 +1,157 @@
+import os
+import json
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from yunohost import app
+import yunohost.hook
+import yunohost.user
+import yunohost.domain
+
+MAIN_DOMAIN = 'main.tld'
+DOMAINS = [MAIN_DOMAIN, 'a.tld', 'b.tld']
+
+
+@pytest.fixture
+def sso(monkeypatch):
+    """Isolate apps settings and SSOwat configuration, stub LDAP"""
+    tmp = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp, 'apps'))
+    current_host = os.path.join(tmp, 'current_host')
+    with open(current_host, 'w') as f:
+        f.write(MAIN_DOMAIN + '\n')
+
+    def _open(path, *args):
+        if path == '/etc/yunohost/current_host':
+            path = current_host
+        return open(path, *args)
+
+    monkeypatch.setattr(app, 'open', _open, raising=False)
+    monkeypatch.setattr(app, 'apps_setting_path', os.path.join(tmp, 'apps/'))
+    monkeypatch.setattr(app, 'ssowat_conf_path', os.path.join(tmp, 'conf.json'))
+    monkeypatch.setattr(app, 'locations_index',
+                        os.path.join(tmp, 'locations.index'))
+    monkeypatch.setattr(app, 'instances_registry',
+                        os.path.join(tmp, 'instances.json'))
+    monkeypatch.delenv('YNH_SSOWAT_REGEN_WINDOW', raising=False)
+
+    users = set(['alice', 'bob'])
+
+    def _user_info(auth, username):
+        if username not in users:
+            raise app.MoulinetteError(1, 'unknown user')
+        return {'username': username}
+
+    monkeypatch.setattr(yunohost.domain, 'domain_list',
+                        lambda auth, **kwargs: {'domains': list(DOMAINS)})
+    monkeypatch.setattr(yunohost.user, 'user_list', lambda auth, **kwargs: {
+        'users': dict((u, {}) for u in users)})
+    monkeypatch.setattr(yunohost.user, 'user_info', _user_info)
+    monkeypatch.setattr(yunohost.hook, 'hook_callback', lambda *a, **kw: {})
+
+    app.app_ssowatconf(None)
+    yield users
+    shutil.rmtree(tmp)
+
+
+def _install(app_id, **settings):
+    os.makedirs(os.path.join(app.apps_setting_path, app_id))
+    settings.update(id=app_id, label=app_id)
+    app._set_app_settings(app_id, settings)
+    app._update_ssowatconf(None)
+
+
+def _remove(app_id):
+    shutil.rmtree(os.path.join(app.apps_setting_path, app_id))
+    app._update_ssowatconf(None)
+
+
+def _assert_as_full_build(users):
+    with open(app.ssowat_conf_path) as f:
+        current = json.load(f)
+    apps_settings = app._get_installed_apps_settings()
+    full = app._build_ssowat_conf(
+        MAIN_DOMAIN, DOMAINS, app._build_users_apps_map(apps_settings, users),
+        apps_settings)
+    assert current == json.loads(json.dumps(full))
+
+
+def test_update_after_apps_changes(sso):
+    _install('foo', domain='a.tld', path='/foo/', mode='private',
+             allowed_users='alice')
+    _assert_as_full_build(sso)
+    _install('bar', domain=MAIN_DOMAIN, path='/', skipped_uris='/,/api',
+             protected_uris='/admin', unprotected_regex='^/pub',
+             redirected_urls={'main.tld/old': 'main.tld/new'})
+    _assert_as_full_build(sso)
+
+    app.app_addaccess(None, ['foo', 'bar'], ['bob'])
+    _assert_as_full_build(sso)
+    app.app_removeaccess(None, ['foo'], ['alice'])
+    _assert_as_full_build(sso)
+    app.app_clearaccess(None, ['foo', 'bar'])
+    _assert_as_full_build(sso)
+
+    _remove('bar')
+    _assert_as_full_build(sso)
+
+
+def test_update_after_users_changes(sso):
+    _install('foo', domain='a.tld', path='/', mode='private',
+             allowed_users='alice,carol')
+    sso.add('carol')
+    app._update_ssowatconf(None, user='carol')
+    _assert_as_full_build(sso)
+
+    sso.discard('alice')
+    app._update_ssowatconf(None, user='alice', user_deleted=True)
+    _assert_as_full_build(sso)
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 8])
+def test_update_after_random_changes(sso, batch_size):
+    rand = random.Random(batch_size)
+    everyone = ['alice', 'bob', 'carol', 'dave']
+
+    def _settings(app_id):
+        settings = {'domain': rand.choice(DOMAINS),
+                    'path': rand.choice(['/', '/x/', '/y/'])}
+        if rand.random() < .5:
+            settings['mode'] = 'private'
+            settings['allowed_users'] = ','.join(rand.sample(everyone, 2))
+        if rand.random() < .5:
+            settings['skipped_uris'] = '/,/api'
+        if rand.random() < .3:
+            settings['protected_uris'] = '/admin'
+        return settings
+
+    for step in range(100):
+        with app._ssowatconf_batch(None):
+            for i in range(batch_size):
+                installed = os.listdir(app.apps_setting_path)
+                r = rand.random()
+                if r < .4 or not installed:
+                    app_id = 'app%d' % rand.randint(1, 20)
+                    if app_id in installed:
+                        _remove(app_id)
+                    _install(app_id, **_settings(app_id))
+                elif r < .55:
+                    _remove(rand.choice(installed))
+                elif r < .75:
+                    app.app_addaccess(None, rand.choice(installed),
+                                      rand.choice(everyone))
+                elif r < .85:
+                    app.app_clearaccess(None, rand.choice(installed))
+                else:
+                    user = rand.choice(everyone)
+                    deleted = user in sso and len(sso) > 1
+                    if deleted:
+                        sso.discard(user)
+                    else:
+                        sso.add(user)
+                    app._update_ssowatconf(None, user=user,
+                                           user_deleted=deleted)
+        _assert_as_full_build(sso)
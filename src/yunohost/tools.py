@@ -39,7 +39,8 @@ import apt.progress
 
 from moulinette.core import MoulinetteError, init_authenticator
 from moulinette.utils.log import getActionLogger
-from yunohost.app import app_fetchlist, app_info, app_upgrade, app_ssowatconf, app_list
+from yunohost.app import app_fetchlist, app_upgrade, app_ssowatconf, app_list, \
+    _get_upgrades_index, _get_app_settings
 from yunohost.domain import domain_add, domain_list, get_public_ip
 from yunohost.dyndns import dyndns_subscribe
 from yunohost.firewall import firewall_upnp, firewall_reload
@@ -317,30 +318,13 @@ def tools_update(ignore_apps=False, ignore_packages=False):
             app_fetchlist()
         except MoulinetteError:
             pass
-        app_list = os.listdir(apps_setting_path)
-        if len(app_list) > 0:
-            for app_id in app_list:
-                if '__' in app_id:
-                    original_app_id = app_id[:app_id.index('__')]
-                else:
-                    original_app_id = app_id
-
-                current_app_dict = app_info(app_id,  raw=True)
-                new_app_dict     = app_info(original_app_id, raw=True)
-
-                # Custom app
-                if new_app_dict is None or 'lastUpdate' not in new_app_dict or 'git' not in new_app_dict:
-                    continue
-
-                if (new_app_dict['lastUpdate'] > current_app_dict['lastUpdate']) \
-                      or ('update_time' not in current_app_dict['settings'] \
-                           and (new_app_dict['lastUpdate'] > current_app_dict['settings']['install_time'])) \
-                      or ('update_time' in current_app_dict['settings'] \
-                           and (new_app_dict['lastUpdate'] > current_app_dict['settings']['update_time'])):
-                    apps.append({
-                        'id': app_id,
-                        'label': current_app_dict['settings']['label']
-                    })
+        upgrades = _get_upgrades_index()
+        for app_id, candidate in sorted(upgrades['apps'].items()):
+            if candidate['upgradable']:
+                apps.append({
+                    'id': app_id,
+                    'label': _get_app_settings(app_id).get('label', None)
+                })
 
     if len(apps) == 0 and len(packages) == 0:
         logger.info(m18n.n('packages_no_upgrade'))
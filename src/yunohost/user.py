@@ -108,7 +108,7 @@ def user_create(auth, username, firstname, lastname, mail, password,
     import pwd
     from yunohost.domain import domain_list
     from yunohost.hook import hook_callback
-    from yunohost.app import app_ssowatconf
+    from yunohost.app import _update_ssowatconf
 
     # Validate uniqueness of username and mail in LDAP
     auth.validate_uniqueness({
@@ -203,7 +203,7 @@ def user_create(auth, username, firstname, lastname, mail, password,
                 if not os.path.isdir('/home/{0}'.format(username)):
                     logger.warning(m18n.n('user_home_creation_failed'),
                                    exc_info=1)
-            app_ssowatconf(auth)
+            _update_ssowatconf(auth, user=username)
             #TODO: Send a welcome mail to user
             logger.success(m18n.n('user_created'))
             hook_callback('post_user_create',
@@ -223,7 +223,7 @@ def user_delete(auth, username, purge=False):
         purge
 
     """
-    from yunohost.app import app_ssowatconf
+    from yunohost.app import _update_ssowatconf
     from yunohost.hook import hook_callback
 
     if auth.remove('uid=%s,ou=users' % username):
@@ -240,7 +240,7 @@ def user_delete(auth, username, purge=False):
     else:
         raise MoulinetteError(169, m18n.n('user_deletion_failed'))
 
-    app_ssowatconf(auth)
+    _update_ssowatconf(auth, user=username, user_deleted=True)
 
     hook_callback('post_user_delete', args=[username, purge])
 
@@ -266,7 +266,7 @@ def user_update(auth, username, firstname=None, lastname=None, mail=None,
 
     """
     from yunohost.domain import domain_list
-    from yunohost.app import app_ssowatconf
+    from yunohost.app import _update_ssowatconf
 
     attrs_to_fetch = ['givenName', 'sn', 'mail', 'maildrop']
     new_attr_dict = {}
@@ -353,7 +353,7 @@ def user_update(auth, username, firstname=None, lastname=None, mail=None,
 
     if auth.update('uid=%s,ou=users' % username, new_attr_dict):
        logger.success(m18n.n('user_updated'))
-       app_ssowatconf(auth)
+       _update_ssowatconf(auth, user=username)
        return user_info(auth, username)
     else:
        raise MoulinetteError(169, m18n.n('user_update_failed'))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+""" License
+
+    Copyright (C) 2016 YUNOHOST.ORG
+
+    This program is free software; you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program; if not, see http://www.gnu.org/licenses
+
+"""
+import os
+import re
+import pwd
+import stat
+import logging
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger('yunohost.utils.filesystem')
+
+re_symbolic_mode = re.compile(r'^(?P<who>[ugoa]*)(?P<op>[-+=])(?P<perms>[rwxX]*)$')
+
+# Permission bits by class of users and permission
+_MODE_BITS = {
+    'u': {'r': stat.S_IRUSR, 'w': stat.S_IWUSR, 'x': stat.S_IXUSR},
+    'g': {'r': stat.S_IRGRP, 'w': stat.S_IWGRP, 'x': stat.S_IXGRP},
+    'o': {'r': stat.S_IROTH, 'w': stat.S_IWOTH, 'x': stat.S_IXOTH},
+}
+
+
+# Permissions ----------------------------------------------------------------
+
+def set_permissions(path, rules, recursive=True):
+    """Apply ownership and permission rules to a tree in a single walk
+
+    Each rule is a dict which applies to the entries of the tree under its
+    `path` - relative to the tree root, the whole tree by default - and
+    which may define:
+      - owner: the name of the user which will own the entries, they will
+          also belong to its primary group - as 'chown user:' does
+      - mode: the permission bits to set, either as an integer or as a
+          symbolic mode - e.g. 'u+rX'
+    The rule with the most specific path applies to each entry. Symbolic
+    links are not followed, only their ownership is changed.
+
+    Keyword arguments:
+        path -- The root of the tree, which can also be a single file
+        rules -- The list of rules to apply
+        recursive -- Apply rules to the tree content and not only its root
+
+    """
+    compiled = []
+    for rule in rules:
+        owner = None
+        if rule.get('owner'):
+            pw = pwd.getpwnam(rule['owner'])
+            owner = (pw.pw_uid, pw.pw_gid)
+        mode = rule.get('mode', None)
+        if isinstance(mode, basestring):
+            mode = _parse_symbolic_mode(mode)
+        compiled.append((rule.get('path', '').strip('/'), owner, mode))
+    # Sort rules from the most specific path
+    compiled.sort(key=lambda r: len(r[0]), reverse=True)
+
+    def _apply(entry_path, relpath, st):
+        for rule_path, owner, mode in compiled:
+            if not rule_path or relpath == rule_path or \
+                    relpath.startswith(rule_path + '/'):
+                break
+        else:
+            return
+        if owner is not None and (st.st_uid, st.st_gid) != owner:
+            os.lchown(entry_path, *owner)
+        if mode is None or stat.S_ISLNK(st.st_mode):
+            return
+        current = stat.S_IMODE(st.st_mode)
+        if callable(mode):
+            new = mode(current, stat.S_ISDIR(st.st_mode))
+        else:
+            new = mode
+        if new != current:
+            os.chmod(entry_path, new)
+
+    st = os.lstat(path)
+    _apply(path, '', st)
+    if not recursive or not stat.S_ISDIR(st.st_mode):
+        return
+
+    # Walk the tree with an explicit stack of directories
+    stack = [(path, '')]
+    while stack:
+        dir_path, dir_relpath = stack.pop()
+        for name, entry_path, st in _iter_directory(dir_path):
+            relpath = name if not dir_relpath else dir_relpath + '/' + name
+            _apply(entry_path, relpath, st)
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((entry_path, relpath))
+
+
+def _iter_directory(path):
+    """Yield the name, the path and the lstat result of directory entries"""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.path, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            yield name, entry_path, os.lstat(entry_path)
+
+
+def _parse_symbolic_mode(mode):
+    """Return a function which applies a symbolic mode to permission bits
+
+    It supports comma-separated clauses of the form [ugoa]*[-+=][rwxX]*, as
+    chmod does - without the umask.
+
+    """
+    clauses = []
+    for clause in mode.split(','):
+        match = re_symbolic_mode.match(clause)
+        if not match:
+            raise ValueError("invalid symbolic mode '%s'" % mode)
+        who = match.group('who').replace('a', 'ugo') or 'ugo'
+        clauses.append((who, match.group('op'), match.group('perms')))
+
+    def _apply_mode(current, is_dir):
+        new = current
+        for who, op, perms in clauses:
+            bits = 0
+            for w in who:
+                for p in perms:
+                    if p == 'X':
+                        # Execute only for directories or files which are
+                        # already executable by someone
+                        if is_dir or current & (stat.S_IXUSR | stat.S_IXGRP
+                                                | stat.S_IXOTH):
+                            bits |= _MODE_BITS[w]['x']
+                    else:
+                        bits |= _MODE_BITS[w][p]
+            if op == '+':
+                new |= bits
+            elif op == '-':
+                new &= ~bits
+            else:
+                for w in who:
+                    new &= ~sum(_MODE_BITS[w].values())
+                new |= bits
+        return new
+    return _apply_mode
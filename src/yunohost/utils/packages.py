@@ -18,15 +18,31 @@
     along with this program; if not, see http://www.gnu.org/licenses
 
 """
+import os
 import re
 import logging
+import threading
+import functools
+import weakref
 from collections import OrderedDict
 
 import apt
-from apt_pkg import version_compare
+import apt_pkg
 
 logger = logging.getLogger('yunohost.utils.packages')
 
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+
+# Package states for which dpkg holds an installed version - i.e. all of
+# them except 'not-installed' and 'config-files', as apt does
+_DPKG_INSTALLED_STATES = frozenset([
+    'installed', 'half-installed', 'unpacked', 'half-configured',
+    'triggers-awaited', 'triggers-pending',
+])
+
+# The dpkg status index and the status file mtime and size it was built from
+_dpkg_status_index = (None, {})
+
 
 # Exceptions -----------------------------------------------------------------
 
@@ -61,6 +77,49 @@ class InvalidSpecifier(ValueError):
     """An invalid specifier was found."""
 
 
+# Memoization helpers --------------------------------------------------------
+
+def _lru_cache(maxsize):
+    """Cache the results of a function for its last `maxsize` arguments
+
+    It is a simple replacement of functools.lru_cache, which is not available
+    in Python 2, and supports only hashable positional arguments. Raised
+    exceptions are not cached.
+
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                try:
+                    result = cache.pop(args)
+                except KeyError:
+                    pass
+                else:
+                    # Move the result to the most recently used end
+                    cache[args] = result
+                    return result
+            result = func(*args)
+            with lock:
+                cache[args] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+@_lru_cache(maxsize=4096)
+def version_compare(a, b):
+    """Compare two package versions as apt_pkg.version_compare does"""
+    return apt_pkg.version_compare(a, b)
+
+
 # Version specifier ----------------------------------------------------------
 # The packaging package has been a nice inspiration for the following classes.
 # See: https://github.com/pypa/packaging
@@ -78,6 +137,9 @@ class Specifier(object):
       - `>=` for greater or equal
       - `>>` for strictly greater
 
+    Specifiers are immutable and interned: creating a specifier equal to an
+    existing one returns the same object.
+
     """
     _regex_str = (
         r"""
@@ -97,20 +159,35 @@ class Specifier(object):
         ">>": "greater_than",
     }
 
-    def __init__(self, spec):
-        if isinstance(spec, basestring):
-            match = self._regex.search(spec)
-            if not match:
-                raise InvalidSpecifier("Invalid specifier: '{0}'".format(spec))
-
-            self._spec = (
-                match.group("relation").strip(),
-                match.group("version").strip(),
-            )
-        elif isinstance(spec, self.__class__):
-            self._spec = spec._spec
-        else:
-            return NotImplemented
+    # Existing specifiers by relation and version
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, spec):
+        if isinstance(spec, cls):
+            return spec
+        elif not isinstance(spec, basestring):
+            raise TypeError("Invalid specifier type: '{0}'".format(
+                type(spec).__name__))
+
+        parsed = cls._parse(spec)
+        try:
+            return cls._interned[parsed]
+        except KeyError:
+            specifier = super(Specifier, cls).__new__(cls)
+            specifier._spec = parsed
+            return cls._interned.setdefault(parsed, specifier)
+
+    @classmethod
+    @_lru_cache(maxsize=1024)
+    def _parse(cls, spec):
+        match = cls._regex.search(spec)
+        if not match:
+            raise InvalidSpecifier("Invalid specifier: '{0}'".format(spec))
+
+        return (
+            match.group("relation").strip(),
+            match.group("version").strip(),
+        )
 
     def __repr__(self):
         return "<Specifier({0!r})>".format(str(self))
@@ -265,14 +342,15 @@ class SpecifierSet(object):
 
     def __init__(self, specifiers):
         if isinstance(specifiers, basestring):
-            specifiers = [s.strip() for s in specifiers.split(",")
-                          if s.strip()]
-
-        parsed = set()
-        for specifier in specifiers:
-            parsed.add(Specifier(specifier))
+            self._specs = self._parse(specifiers)
+        else:
+            self._specs = frozenset(Specifier(s) for s in specifiers)
 
-        self._specs = frozenset(parsed)
+    @staticmethod
+    @_lru_cache(maxsize=1024)
+    def _parse(specifiers):
+        return frozenset(Specifier(s.strip()) for s in specifiers.split(",")
+                         if s.strip())
 
     def __repr__(self):
         return "<SpecifierSet({0!r})>".format(str(self))
@@ -389,6 +467,53 @@ class SpecifierSet(object):
 
 # Packages and cache helpers -------------------------------------------------
 
+def get_dpkg_status_index():
+    """Get the installed version of packages from the dpkg status file
+
+    Return a dict of installed packages names and their version, built by
+    reading the dpkg status file and cached until it is modified. Packages
+    installed for a foreign architecture are only indexed with their
+    architecture qualifier - e.g. 'libc6:i386'.
+
+    """
+    global _dpkg_status_index
+
+    try:
+        st = os.stat(DPKG_STATUS_PATH)
+    except OSError:
+        return {}
+    stamp = (st.st_mtime, st.st_size)
+    if _dpkg_status_index[0] == stamp:
+        return _dpkg_status_index[1]
+
+    native_archs = ('all', apt_pkg.config.find('APT::Architecture'))
+    index = {}
+
+    with open(DPKG_STATUS_PATH, 'r') as f:
+        for stanza in f.read().split('\n\n'):
+            fields = {}
+            for line in stanza.splitlines():
+                # Only keep the fields we need - skipping continuation lines
+                if line[:8] in ('Package:', 'Status: ', 'Version:') \
+                        or line[:13] == 'Architecture:':
+                    key, value = line.split(':', 1)
+                    fields[key] = value.strip()
+            try:
+                state = fields['Status'].split()[2]
+                name, version = fields['Package'], fields['Version']
+            except (KeyError, IndexError):
+                continue
+            if state not in _DPKG_INSTALLED_STATES:
+                continue
+            arch = fields.get('Architecture', 'all')
+            if arch in native_archs:
+                index[name] = version
+            index['%s:%s' % (name, arch)] = version
+
+    _dpkg_status_index = (stamp, index)
+    return index
+
+
 def get_installed_version(*pkgnames, **kwargs):
     """Get the installed version of package(s)
 
@@ -397,27 +522,37 @@ def get_installed_version(*pkgnames, **kwargs):
     `False`. If `strict` is `True`, an exception will be raised if a package
     is unknown or not installed.
 
+    Installed versions are read from the dpkg status index, the apt cache
+    is only loaded to report the packages which are not installed.
+
     """
     versions = OrderedDict()
-    cache = apt.Cache()
+    installed = get_dpkg_status_index()
+    cache = None
 
     # Retrieve options
     as_dict = kwargs.get('as_dict', False)
     strict = kwargs.get('strict', False)
 
     for pkgname in pkgnames:
-        try:
-            pkg = cache[pkgname]
-        except KeyError:
-            if strict:
-                raise UnknownPackage(pkgname)
-            logger.warning(m18n.n('package_unknown', pkgname=pkgname))
-        try:
-            version = pkg.installed.version
-        except AttributeError:
-            if strict:
-                raise UninstalledPackage(pkgname)
-            version = None
+        version = installed.get(pkgname)
+        if version is None:
+            # Fallback to the apt cache to know if the package exists
+            if cache is None:
+                cache = apt.Cache()
+            try:
+                pkg = cache[pkgname]
+            except KeyError:
+                if strict:
+                    raise UnknownPackage(pkgname)
+                logger.warning(m18n.n('package_unknown', pkgname=pkgname))
+                pkg = None
+            try:
+                version = pkg.installed.version
+            except AttributeError:
+                if strict:
+                    raise UninstalledPackage(pkgname)
+                version = None
         versions[pkgname] = version
 
     if len(pkgnames) == 1 and not as_dict:
@@ -429,6 +564,29 @@ def meets_version_specifier(pkgname, specifier):
     spec = SpecifierSet(specifier)
     return get_installed_version(pkgname) in spec
 
+def check_requirements(requirements, versions=None):
+    """Check several sets of requirements against installed versions
+
+    Check in one pass each set of packages requirements - given as a dict
+    of packages names and version specifiers - of the `requirements` dict,
+    against the packages versions of `versions` - which defaults to the
+    installed ones. Return a dict with the same keys and the list of unmet
+    requirements of each set as (pkgname, version, specifier) tuples - the
+    version being `None` if the package is not installed.
+
+    """
+    if versions is None:
+        versions = get_dpkg_status_index()
+
+    unmet = OrderedDict()
+    for key, reqs in requirements.items():
+        unmet[key] = []
+        for pkgname, spec in reqs.items():
+            version = versions.get(pkgname)
+            if version is None or version not in SpecifierSet(spec):
+                unmet[key].append((pkgname, version, spec))
+    return unmet
+
 
 # YunoHost related methods ---------------------------------------------------
 